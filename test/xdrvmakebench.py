@@ -0,0 +1,173 @@
+#!/usr/bin/python3 -u
+"""
+Micro-benchmarks for the configure hot paths on synthetic large inputs.
+
+    python test/xdrvmakebench.py --update-baseline  # record a baseline
+    python test/xdrvmakebench.py                    # compare with it
+
+Results are printed as JSON (seconds per call, best of --repeat runs). The
+baseline is machine specific, so it is recorded locally and not committed:
+check out the reference revision, record it, then compare the change against
+it. Every run also times a fixed pure-python calibration loop, and results
+are scaled by the calibration ratio of the two runs, so a busier or slower
+machine state doesn't read as a regression. The run fails if any benchmark
+is slower than the scaled baseline * (1 + --tolerance), and if there is no
+baseline to compare with, unless --allow-missing-baseline is given.
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xdrvmake import builder  # noqa: E402
+
+default_baseline = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+
+plats = ["rpi-v6", "rpi-v7", "rpi-v7l", "rpi-v8", "rpi-2712", "rpi-v8-rt"]
+
+
+def synthetic_versions(count: int, plat: str) -> list[str]:
+    return [f"6.{i // 100}.{i % 100}+rpt-{plat}" for i in range(count)]
+
+
+def synthetic_apt_list(lines: int) -> list[str]:
+    out = []
+    for i in range(lines):
+        plat = plats[i % len(plats)]
+        ver = f"6.{i // 600}.{i % 100}+rpt"
+        if i % 3 == 0:
+            # unrelated packages the parser has to skip
+            out.append(f"linux-image-{ver}-{plat}/stable 1:{ver}-1 arm64")
+        else:
+            out.append(f"linux-headers-{ver}-{plat}/stable 1:{ver}-1+rpt1 arm64")
+    return out
+
+
+def makefile_data(kernels: int) -> dict:
+    versions = {p: synthetic_versions(kernels // len(plats), p) for p in plats}
+    data: dict = {
+        "project": "benchdrv",
+        "modulename": "benchmod",
+        "maintainer": "bench@example.com",
+        "description": "benchmark driver",
+        "version": "1.0.0",
+        "architecture": "arm64",
+        "projectroot": "/bench/project",
+    }
+    builder.load_manifest_data(data, versions)
+    return data
+
+
+def benchmarks() -> dict[str, Callable[[], object]]:
+    apt_lines = synthetic_apt_list(40000)
+    apt_text = "\n".join(apt_lines)
+    semvers = synthetic_versions(50000, "rpi-v8")
+    manifest = {p: synthetic_versions(500, p) for p in plats}
+    data = makefile_data(300)
+    builder.init_template_env()
+    return {
+        "extract_kernel_version_ids_40k_lines": lambda: (
+            builder.extract_kernel_version_ids(apt_text, plats)
+        ),
+        "parse_kernel_version_ids_40k_streamed": lambda: (
+            builder.parse_kernel_version_ids(iter(apt_lines), plats)
+        ),
+        "semver_key_sort_50k": lambda: sorted(semvers, key=builder.semver_key),
+        "load_manifest_data_3000_kernels": lambda: builder.load_manifest_data(
+            {}, {p: list(v) for p, v in manifest.items()}
+        ),
+        "get_template_makefile": lambda: builder.get_template("Makefile"),
+        "render_makefile_300_kernels": lambda: builder.render_makefile(dict(data)),
+    }
+
+
+def calibration() -> object:
+    # the same kind of interpreter work as the benchmarks (string splitting,
+    # sorting), independent of the code under test
+    return sorted(f"{i % 977}.{i}".split(".")[0] for i in range(20000))
+
+
+def time_call(fn: Callable[[], object], repeat: int) -> float:
+    number, _ = timeit.Timer(fn).autorange()
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def run(repeat: int) -> dict[str, float]:
+    results = {"calibration": time_call(calibration, repeat)}
+    for name, fn in benchmarks().items():
+        results[name] = time_call(fn, repeat)
+    # timed again last, the machine state may have changed during the run
+    results["calibration"] = min(results["calibration"], time_call(calibration, repeat))
+    return results
+
+
+def compare(
+    results: dict[str, float], baseline: dict[str, float], tolerance: float
+) -> list[str]:
+    scale = 1.0
+    if "calibration" in results and "calibration" in baseline:
+        scale = results["calibration"] / baseline["calibration"]
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if name == "calibration" or base is None:
+            continue
+        if seconds > base * scale * (1 + tolerance):
+            regressions.append(
+                f"{name}: {seconds * 1e6:.1f}us vs baseline {base * 1e6:.1f}us "
+                f"scaled to {base * scale * 1e6:.1f}us"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--allow-missing-baseline",
+        action="store_true",
+        help="succeed without a baseline instead of failing",
+    )
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=float(os.environ.get("XDRVMAKE_BENCH_TOLERANCE", "0.5")),
+        help="allowed slowdown relative to the baseline (0.5 = 50%%)",
+    )
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    report = json.dumps({"unit": "seconds/call", "results": results}, indent=4)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+            f.write("\n")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(
+            f"no baseline at {args.baseline}, record one with --update-baseline",
+            file=sys.stderr,
+        )
+        return 0 if args.allow_missing_baseline else 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,11 +3,14 @@
 import argparse
 import unittest
 import textwrap
+import os
+from unittest.mock import patch
 from xdrvmake.builder import (
     compute_kernel_versions_to_install,
     extract_kernel_version_ids_single,
     get_target_kernel_package_names,
     extract_kernel_version_ids,
+    parse_kernel_version_ids,
 )
 
 sample_target_file = textwrap.dedent(
@@ -146,6 +149,30 @@ class TestAptKernelVersionParsing(unittest.TestCase):
             },
         )
 
+    def test_parsing_apt_output_streamed_lines(self):
+        lines = (line for line in apt_list_combined.splitlines())
+        versions = parse_kernel_version_ids(lines, ["rpi-v8", "rpi-2712", "rpi-v7"])
+        self.assertEqual(
+            versions["rpi-2712"],
+            [
+                "6.12.62+rpt-rpi-2712",
+                "6.12.47+rpt-rpi-2712",
+                "6.12.34+rpt-rpi-2712",
+                "6.12.25+rpt-rpi-2712",
+            ],
+        )
+        self.assertEqual(versions["rpi-v8"][0], "6.12.62+rpt-rpi-v8")
+        self.assertEqual(versions["rpi-v7"], [])
+
+    def test_parsing_apt_output_prefers_longest_target(self):
+        lines = [
+            "linux-headers-6.6.74+rpt-rpi-v7l/stable 1:6.6.74-1+rpt1 armhf",
+            "linux-headers-6.6.74+rpt-rpi-v7/stable 1:6.6.74-1+rpt1 armhf",
+        ]
+        versions = parse_kernel_version_ids(lines, ["rpi-v7", "rpi-v7l"])
+        self.assertEqual(versions["rpi-v7"], ["6.6.74+rpt-rpi-v7"])
+        self.assertEqual(versions["rpi-v7l"], ["6.6.74+rpt-rpi-v7l"])
+
     def test_compute_kernel_versions_to_install(self):
         available_versions = {
             "rpi-2712": [
@@ -199,6 +226,27 @@ class TestBuilderUtils(unittest.TestCase):
             with self.assertRaises(ValueError):
                 get_arch(f.name)
 
+    def test_resolve_build_constants(self):
+        import tempfile
+        from xdrvmake.builder import resolve_build_constants
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "target"), "w") as f:
+                f.write("TARGET_ARCH='arm64'\nVERSION_CODENAME=trixie\n")
+            common = os.path.join(
+                tmp, "usr", "src", "linux-headers-6.12.34+rpt-common-rpi"
+            )
+            os.makedirs(common)
+            args = argparse.Namespace(target_dir=tmp, chroot_root=tmp + "/")
+            data: dict = {
+                "kernel_versions": ["6.12.34+rpt-rpi-v8", "6.12.62+rpt-rpi-v8"]
+            }
+            resolve_build_constants(args, data)
+            self.assertEqual(data["distro"], "trixie")
+            self.assertEqual(
+                data["kernel_common_headers"], {"6.12.34+rpt-rpi-v8": common}
+            )
+
     def test_get_template_and_render(self):
         from xdrvmake.builder import get_template
 
@@ -206,6 +254,35 @@ class TestBuilderUtils(unittest.TestCase):
         tmpl = get_template("Makefile")
         self.assertTrue(hasattr(tmpl, "render"))
 
+    def test_get_template_shares_compiled_code(self):
+        from xdrvmake import builder
+
+        builder.init_template_env()
+        tmpl1 = builder.get_template("control")
+        tmpl2 = builder.get_template("control")
+        self.assertIsNot(tmpl1, tmpl2)
+        self.assertIsNot(tmpl1.globals, tmpl2.globals)
+        self.assertEqual(builder._compile_template.cache_info().misses, 1)
+        self.assertEqual(builder._compile_template.cache_info().hits, 1)
+
+    def test_template_bytecode_cache(self):
+        import tempfile
+        import os
+        from xdrvmake import builder
+
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                builder.init_template_env(tmp)
+                builder.get_template("Makefile")
+                self.assertTrue(os.listdir(tmp))
+                # a fresh environment loads the code from the persisted cache
+                env = builder.init_template_env(tmp)
+                with patch.object(env, "compile") as compile:
+                    builder.get_template("Makefile")
+                    compile.assert_not_called()
+            finally:
+                builder.init_template_env()
+
     def test_set_globals(self):
         from xdrvmake.builder import get_template, set_globals
 
@@ -265,6 +342,52 @@ class TestBuilderUtils(unittest.TestCase):
         with self.assertRaises(Exception):
             exec_command(["false"])
 
+    def test_exec_command_drains_stderr(self):
+        import subprocess
+        import sys
+        from xdrvmake.builder import exec_command
+
+        # far more stderr than a pipe buffer holds, must not deadlock
+        script = (
+            "import sys\n"
+            "for i in range(20000):\n"
+            "    sys.stderr.write('err %d\\n' % i)\n"
+            "    print(i)\n"
+            "sys.exit(3)\n"
+        )
+        seen: list[str] = []
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            exec_command(
+                [sys.executable, "-c", script],
+                on_line=seen.append,
+                on_stderr=None,
+                max_lines=5,
+                timeout=60,
+            )
+        self.assertEqual(len(seen), 20000)
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.stderr.splitlines()[-1], "err 19999")
+        self.assertEqual(len(ctx.exception.stderr.splitlines()), 5)
+
+    def test_exec_command_output_is_capped(self):
+        import sys
+        from xdrvmake.builder import exec_command
+
+        output = exec_command(
+            [sys.executable, "-c", "for i in range(100): print(i)"], max_lines=3
+        )
+        self.assertEqual(output, "97\n98\n99")
+
+    def test_exec_command_timeout(self):
+        import subprocess
+        import sys
+        from xdrvmake.builder import exec_command
+
+        with self.assertRaises(subprocess.TimeoutExpired):
+            exec_command(
+                [sys.executable, "-c", "import time; time.sleep(30)"], timeout=0.2
+            )
+
     def test_render_debian_file_and_create_stating(self):
         import tempfile
         import os
@@ -369,6 +492,7 @@ class TestBuilderUtils(unittest.TestCase):
         self.assertEqual(get_kernel_vers(Args), ["foo", "bar"])
 
     def test_build_driver(self):
+        import tempfile
         from xdrvmake.builder import build_driver
 
         called = []
@@ -383,12 +507,100 @@ class TestBuilderUtils(unittest.TestCase):
         xdrvmake.builder.exec_make = fake_exec_make
 
         try:
-            build_driver(argparse.Namespace(build="/test"))
+            with patch(
+                "xdrvmake.builder.exec_command"
+            ) as exec_command, tempfile.TemporaryDirectory() as build:
+                build_driver(
+                    argparse.Namespace(
+                        build=build, chroot_name="buildroot", schroot_session=None
+                    )
+                )
+            # the whole build runs in a single schroot session
+            self.assertEqual(
+                exec_command.call_args_list[0][0][0][:2], ["schroot", "-b"]
+            )
+            self.assertEqual(
+                exec_command.call_args_list[-1][0][0][:2], ["schroot", "-e"]
+            )
             # Should call make all target (Makefile handles per-version builds)
             self.assertEqual(called, ["all"])
         finally:
             xdrvmake.builder.exec_make = old_exec_make
 
+    def test_build_driver_skips_schroot_when_not_needed(self):
+        import json
+        import shutil
+        import tempfile
+        from xdrvmake import builder
+
+        if shutil.which("make") is None or shutil.which("cpp") is None:
+            self.skipTest("make or cpp is not installed")
+        with tempfile.TemporaryDirectory() as tmp:
+            project = os.path.join(tmp, "project")
+            build = os.path.join(tmp, "build")
+            bin_dir = os.path.join(tmp, "bin")
+            for d in (project, f"{build}/staging/DEBIAN", bin_dir):
+                os.makedirs(d)
+            with open(os.path.join(project, "mydriver.dts"), "w") as f:
+                f.write("/dts-v1/;\n/ { };\n")
+            with open(os.path.join(build, "staging/DEBIAN/control"), "w") as f:
+                f.write("Package: mydriver\n")
+            # stand-ins writing their output file
+            for tool, script in (
+                ("dtc", 'while [ "$1" != -o ]; do shift; done\ncp "$3" "$2"\n'),
+                ("dpkg-deb", 'for last; do :; done\ntouch "$last"\n'),
+            ):
+                with open(os.path.join(bin_dir, tool), "w") as f:
+                    f.write(f"#!/bin/sh\n{script}")
+                os.chmod(os.path.join(bin_dir, tool), 0o755)
+            # a dts_only project has no module target
+            data: dict = {
+                "project": "mydriver",
+                "modulename": "mymod",
+                "maintainer": "test@example.com",
+                "description": "Test driver",
+                "version": "1.0.0",
+                "architecture": "arm64",
+                "min_supported": [],
+                "max_supported": [],
+                "kernel_versions": ["6.1.0-rpi-v8"],
+                "dts_only": True,
+                "distro": "bullseye",
+                "projectroot": project,
+                "chroot_root": tmp,
+            }
+            with open(os.path.join(build, "Makefile"), "w") as f:
+                f.write(builder.render_makefile(dict(data)))
+            with open(os.path.join(build, builder.build_graph_filename), "w") as f:
+                json.dump(builder.compute_build_graph(data), f)
+            args = argparse.Namespace(
+                build=build,
+                chroot_name="buildroot",
+                schroot_session=None,
+                jobs=1,
+                engine="make",
+            )
+            env = {"XDRVMAKE_LOCK_DIR": tmp, "PATH": f"{bin_dir}:{os.environ['PATH']}"}
+            with patch.dict(os.environ, env), patch(
+                "xdrvmake.builder.exec_command", wraps=builder.exec_command
+            ) as exec_command:
+                # only the overlay is stale, it's compiled on the host
+                builder.build_driver(args)
+                self.assertTrue(
+                    os.path.exists(os.path.join(build, "mydriver_1.0.0-1_arm64.deb"))
+                )
+                self.assertEqual(len(exec_command.call_args_list), 1)
+                self.assertEqual(
+                    exec_command.call_args[0][0][:3], ["make", "-C", build]
+                )
+                # nothing is stale, nothing runs
+                exec_command.reset_mock()
+                builder.build_driver(args)
+                exec_command.assert_not_called()
+                # changed package metadata repackages
+                os.utime(os.path.join(build, "staging/DEBIAN/control"))
+                self.assertFalse(builder.build_up_to_date(build))
+
     def test_parallel_build_args_parsing(self):
         import sys
         import os
@@ -419,7 +631,7 @@ class TestBuilderUtils(unittest.TestCase):
 
         called_cmds = []
 
-        def fake_exec_command(cmd):
+        def fake_exec_command(cmd, *args, **kwargs):
             called_cmds.append(cmd)
             return ""
 
@@ -448,6 +660,46 @@ class TestBuilderUtils(unittest.TestCase):
         finally:
             xdrvmake.builder.exec_command = old_exec_command
 
+    def test_schroot_session(self):
+        from xdrvmake.builder import schroot_command, schroot_session
+
+        args = argparse.Namespace(chroot_name="buildroot", schroot_session=None)
+        self.assertEqual(
+            schroot_command(args, ["apt_update"]),
+            ["schroot", "-c", "buildroot", "-u", "root", "-d", "/", "--", "apt_update"],
+        )
+        with patch("xdrvmake.builder.exec_command") as exec_command:
+            with self.assertRaises(RuntimeError):
+                with schroot_session(args) as session:
+                    self.assertEqual(
+                        schroot_command(args, ["apt_update"])[:3],
+                        ["schroot", "-r", "-c"],
+                    )
+                    self.assertEqual(schroot_command(args, ["ls"])[3], session)
+                    # nested sessions are reused
+                    with schroot_session(args) as nested:
+                        self.assertEqual(nested, session)
+                    raise RuntimeError("build failed")
+        # begin + end only, the session is closed even on failure
+        self.assertEqual(
+            [c[0][0] for c in exec_command.call_args_list],
+            [
+                ["schroot", "-b", "-c", "buildroot", "-n", session],
+                ["schroot", "-e", "-c", session],
+            ],
+        )
+        self.assertIsNone(args.schroot_session)
+
+    def test_exec_make_passes_schroot_session(self):
+        from xdrvmake.builder import exec_make
+
+        args = argparse.Namespace(build="/b", jobs=1, schroot_session="sess")
+        with patch("xdrvmake.builder.exec_command") as exec_command:
+            exec_make(args, "all")
+        exec_command.assert_called_once_with(
+            ["make", "-C", "/b", "SCHROOT_SESSION=sess", "all"]
+        )
+
     def test_install_kernel_headers_and_load_manifest(self):
         import tempfile
         import shutil
@@ -472,6 +724,7 @@ class TestBuilderUtils(unittest.TestCase):
             target_dir=target_dir,
             chroot_name="buildroot",
             kernel_ver_count=1,
+            apt_update_ttl=0,
         )
         data = {
             "project": "TestProj",
@@ -489,14 +742,24 @@ class TestBuilderUtils(unittest.TestCase):
             "max_supported": [],
         }
         manifest_path = os.path.join(os.getcwd(), "kernel_version_file_list.json")
-        if os.path.exists(manifest_path):
-            os.remove(manifest_path)
+        fingerprint_path = os.path.join(
+            os.getcwd(), "kernel_version_file_list.fingerprint.json"
+        )
+        for path in (manifest_path, fingerprint_path):
+            if os.path.exists(path):
+                os.remove(path)
 
         with patch(
-            "xdrvmake.builder.exec_command",
-            return_value="linux-headers-6.1.0-rpi-v8/stable,now 1:6.1.0-1+rpt1 arm64 [installed]\n"
-            "linux-headers-6.1.0-rpi-v7/stable,now 1:6.1.0-1+rpt1 arm64 [installed]",
-        ), patch("xdrvmake.builder.apt_update_in_buildroot", return_value=None), patch(
+            "xdrvmake.builder.iter_command",
+            return_value=iter(
+                [
+                    "linux-headers-6.1.0-rpi-v8/stable,now 1:6.1.0-1+rpt1 arm64 [installed]",
+                    "linux-headers-6.1.0-rpi-v7/stable,now 1:6.1.0-1+rpt1 arm64 [installed]",
+                ]
+            ),
+        ), patch("xdrvmake.builder.exec_command"), patch(
+            "xdrvmake.builder.apt_update_in_buildroot", return_value=None
+        ), patch(
             "xdrvmake.builder.apt_install_kernel_headers_in_buildroot",
             return_value=None,
         ):
@@ -518,8 +781,247 @@ class TestBuilderUtils(unittest.TestCase):
             self.assertTrue(data2["min_supported"])
             self.assertTrue(data2["max_supported"])
         shutil.rmtree(temp_dir)
-        if os.path.exists(manifest_path):
-            os.remove(manifest_path)
+        for path in (manifest_path, fingerprint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_install_only_missing_kernel_headers(self):
+        import tempfile
+        from xdrvmake import builder
+
+        with tempfile.TemporaryDirectory() as tmp:
+            chroot_root = os.path.join(tmp, "chroot")
+            lists = os.path.join(chroot_root, "var", "lib", "apt", "lists")
+            os.makedirs(lists)
+            os.makedirs(os.path.join(chroot_root, "lib", "modules", "6.1.1-rpi-v8"))
+            with open(os.path.join(lists, "x_Packages"), "w") as f:
+                f.write("Package: linux-headers-6.1.0-rpi-v8\n")
+                f.write("Package: linux-headers-6.1.1-rpi-v8\n")
+            with open(os.path.join(tmp, "target"), "w") as f:
+                f.write("RPI_KERNEL_VER_LIST=6.1.0-rpi-v8\n")
+            args = argparse.Namespace(
+                chroot_root=chroot_root,
+                target_dir=tmp,
+                chroot_name="buildroot",
+                schroot_session=None,
+                kernel_ver_count=2,
+                apt_update_ttl=3600,
+            )
+            old = os.getcwd()
+            os.chdir(tmp)
+            try:
+                with patch("xdrvmake.builder.exec_command") as exec_command, patch(
+                    "xdrvmake.builder.apt_update_in_buildroot"
+                ) as update, patch(
+                    "xdrvmake.builder.apt_install_kernel_headers_in_buildroot"
+                ) as install:
+                    builder.install_kernel_headers(args, {"project": "p"})
+                    # the lists were just refreshed, only the missing header
+                    # is installed
+                    update.assert_not_called()
+                    install.assert_called_once_with(
+                        args, ["linux-headers-6.1.0-rpi-v8"]
+                    )
+                    # both installed now, nothing needs the chroot
+                    os.makedirs(
+                        os.path.join(chroot_root, "lib", "modules", "6.1.0-rpi-v8")
+                    )
+                    os.remove("kernel_version_file_list.json")
+                    install.reset_mock()
+                    exec_command.reset_mock()
+                    builder.install_kernel_headers(args, {"project": "p"})
+                    install.assert_not_called()
+                    exec_command.assert_not_called()
+                    # stale lists are updated first
+                    old_time = 1_000_000_000
+                    os.utime(lists, (old_time, old_time))
+                    with open("kernel_version_file_list.fingerprint.json", "w") as f:
+                        f.write("{}")
+                    builder.install_kernel_headers(args, {"project": "p"})
+                    update.assert_called_once_with(args)
+                    # emptied lists are updated however recent they are
+                    os.remove(os.path.join(lists, "x_Packages"))
+                    os.utime(lists)
+                    update.reset_mock()
+
+                    def refill_lists(args):
+                        with open(os.path.join(lists, "x_Packages"), "w") as f:
+                            f.write("Package: linux-headers-6.1.1-rpi-v8\n")
+
+                    update.side_effect = refill_lists
+                    builder.install_kernel_headers(args, {"project": "p"})
+                    update.assert_called_once_with(args)
+            finally:
+                os.chdir(old)
+
+    def test_read_apt_index_kernel_headers(self):
+        import gzip
+        import tempfile
+        from xdrvmake import builder
+
+        packages = textwrap.dedent(
+            """\
+            Package: linux-headers-6.12.34+rpt-rpi-v8
+            Version: 1:6.12.34-1+rpt1
+
+            Package: linux-headers-6.12.62+rpt-rpi-v8
+            Version: 1:6.12.62-1+rpt1
+
+            Package: linux-headers-6.12.62+rpt-common-rpi
+            Version: 1:6.12.62-1+rpt1
+
+            Package: linux-headers-rpi-v8
+            Version: 1:6.12.62-1+rpt1
+            """
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            lists = os.path.join(tmp, "var", "lib", "apt", "lists")
+            os.makedirs(lists)
+            args = argparse.Namespace(chroot_root=tmp)
+            old = os.getcwd()
+            os.chdir(tmp)
+            try:
+                self.assertIsNone(builder.read_apt_index_kernel_headers(args, ["v8"]))
+                with open(
+                    os.path.join(lists, "a_main_binary-arm64_Packages"), "w"
+                ) as f:
+                    f.write(packages)
+                with gzip.open(
+                    os.path.join(lists, "b_main_binary-arm64_Packages.gz"), "wt"
+                ) as f:
+                    f.write("Package: linux-headers-6.12.47+rpt-rpi-2712\n")
+                expected = {
+                    "rpi-v8": ["6.12.62+rpt-rpi-v8", "6.12.34+rpt-rpi-v8"],
+                    "rpi-2712": ["6.12.47+rpt-rpi-2712"],
+                }
+                self.assertEqual(
+                    builder.read_apt_index_kernel_headers(args, ["rpi-v8", "rpi-2712"]),
+                    expected,
+                )
+                # unchanged indexes are served from the cache
+                with patch(
+                    "xdrvmake.builder.iter_apt_index_kernel_headers"
+                ) as read_index:
+                    self.assertEqual(
+                        builder.read_apt_index_kernel_headers(
+                            args, ["rpi-v8", "rpi-2712"]
+                        ),
+                        expected,
+                    )
+                    read_index.assert_not_called()
+                # unreadable compression falls back to apt list
+                open(os.path.join(lists, "c_Packages.lz4"), "w").close()
+                self.assertIsNone(
+                    builder.read_apt_index_kernel_headers(args, ["rpi-v8"])
+                )
+            finally:
+                os.chdir(old)
+
+    def test_install_kernel_headers_fingerprint(self):
+        import tempfile
+        import json
+        from xdrvmake import builder
+
+        apt_lines = [
+            "linux-headers-6.1.0-rpi-v8/stable 1:6.1.0-1+rpt1 arm64",
+            "linux-headers-6.1.1-rpi-v8/stable 1:6.1.1-1+rpt1 arm64",
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            chroot_root = os.path.join(tmp, "chroot")
+            lists = os.path.join(chroot_root, "var", "lib", "apt", "lists")
+            os.makedirs(lists)
+            # an index only apt list can read
+            open(os.path.join(lists, "x_Packages.lz4"), "w").close()
+            os.makedirs(os.path.join(chroot_root, "lib", "modules"))
+            with open(os.path.join(tmp, "target"), "w") as f:
+                f.write("RPI_KERNEL_VER_LIST=6.1.0-rpi-v8\n")
+            args = argparse.Namespace(
+                chroot_root=chroot_root,
+                target_dir=tmp,
+                chroot_name="buildroot",
+                schroot_session=None,
+                kernel_ver_count=1,
+                apt_update_ttl=0,
+            )
+            old = os.getcwd()
+            os.chdir(tmp)
+            try:
+                with patch("xdrvmake.builder.exec_command"), patch(
+                    "xdrvmake.builder.apt_update_in_buildroot"
+                ) as update, patch(
+                    "xdrvmake.builder.apt_list_kernel_headers_in_buildroot",
+                    side_effect=lambda *_: iter(apt_lines),
+                ) as apt_list, patch(
+                    "xdrvmake.builder.apt_install_kernel_headers_in_buildroot"
+                ) as install:
+
+                    def configure():
+                        update.reset_mock()
+                        apt_list.reset_mock()
+                        install.reset_mock()
+                        data = {"project": "p"}
+                        builder.install_kernel_headers(args, data)
+                        return data
+
+                    configure()
+                    self.assertEqual(update.call_count, 1)
+                    self.assertEqual(apt_list.call_count, 1)
+                    install.assert_called_once_with(
+                        args, ["linux-headers-6.1.1-rpi-v8"]
+                    )
+                    # warm run, nothing changed and the lists are fresh
+                    args.apt_update_ttl = 3600
+                    data = configure()
+                    update.assert_not_called()
+                    apt_list.assert_not_called()
+                    install.assert_not_called()
+                    self.assertEqual(data["kernel_versions"], ["6.1.1-rpi-v8"])
+                    # more kernels: reuse the apt list result, install again
+                    args.kernel_ver_count = 2
+                    data = configure()
+                    update.assert_not_called()
+                    apt_list.assert_not_called()
+                    install.assert_called_once()
+                    self.assertEqual(
+                        data["kernel_versions"], ["6.1.0-rpi-v8", "6.1.1-rpi-v8"]
+                    )
+                    with open("kernel_version_file_list.json") as f:
+                        self.assertEqual(len(json.load(f)["rpi-v8"]), 2)
+                    # refreshed apt lists invalidate the apt list stage,
+                    # readable indexes are parsed without running apt list
+                    os.remove(os.path.join(lists, "x_Packages.lz4"))
+                    with open(os.path.join(lists, "x_Packages"), "w") as f:
+                        f.write(
+                            "Package: linux-headers-6.1.2-rpi-v8\nVersion: 1:6.1.2\n"
+                        )
+                    data = configure()
+                    update.assert_not_called()
+                    apt_list.assert_not_called()
+                    install.assert_called_once_with(
+                        args, ["linux-headers-6.1.2-rpi-v8"]
+                    )
+                    self.assertEqual(data["kernel_versions"], ["6.1.2-rpi-v8"])
+                    # lists older than the ttl bypass the matching fingerprint,
+                    # the update finds the new upstream headers
+                    args.apt_update_ttl = 0
+
+                    def publish_headers(args):
+                        with open(os.path.join(lists, "x_Packages"), "a") as f:
+                            f.write(
+                                "\nPackage: linux-headers-6.1.3-rpi-v8\n"
+                                "Version: 1:6.1.3\n"
+                            )
+
+                    update.side_effect = publish_headers
+                    data = configure()
+                    self.assertEqual(update.call_count, 1)
+                    install.assert_called_once()
+                    self.assertIn("linux-headers-6.1.3-rpi-v8", install.call_args[0][1])
+                    self.assertEqual(
+                        data["kernel_versions"], ["6.1.2-rpi-v8", "6.1.3-rpi-v8"]
+                    )
+            finally:
+                os.chdir(old)
 
     def test_setup_derived_data(self):
         import tempfile
@@ -643,10 +1145,20 @@ class TestBuilderUtils(unittest.TestCase):
         self.assertIn(
             "quickdeploy-6.12.34+rpt-rpi-v8: driver-6.12.34+rpt-rpi-v8", makefile
         )
-        self.assertIn("scp staging/lib/modules/6.12.34+rpt-rpi-v8/mymod.ko", makefile)
+        self.assertIn("< staging/lib/modules/6.12.34+rpt-rpi-v8/mymod.ko", makefile)
         self.assertIn("sudo rmmod mymod", makefile)
         self.assertIn("sudo modprobe mymod", makefile)
 
+        # every deploy runs a single remote script over the multiplexed connection
+        self.assertIn("-o ControlMaster=auto -o ControlPath=", makefile)
+        self.assertIn('rsync -e "$(SSH)"', makefile)
+        self.assertNotIn("scp ", makefile)
+        recipes = makefile.split("\n\n")
+        for target in ("quickdeploy-6.12.34+rpt-rpi-v8:", "deploy: all"):
+            (recipe,) = [r for r in recipes if r.lstrip("\n").startswith(target)]
+            self.assertEqual(recipe.count("$(SSH) $(TARGET)"), 1)
+            self.assertNotIn("\tssh ", recipe)
+
         # Verify aggregate all-drivers target
         self.assertIn("all-drivers:", makefile)
         self.assertIn("driver-6.12.34+rpt-rpi-v8", makefile)
@@ -669,6 +1181,30 @@ class TestBuilderUtils(unittest.TestCase):
         self.assertNotIn(
             "schroot -c buildroot -u root -d /tmp/drv-mydriver --", makefile
         )
+        self.assertIn(
+            "$(SCHROOT) -u root -d /tmp/drv-mydriver-6.12.34+rpt-rpi-v8 --", makefile
+        )
+        self.assertIn("SCHROOT = schroot -r -c $(SCHROOT_SESSION)", makefile)
+        # the inner kbuild is a recursive make sharing the jobserver
+        self.assertIn(
+            "\t+$(SCHROOT) -u root -d /tmp/drv-mydriver-6.12.34+rpt-rpi-v8 -- "
+            "$(KBUILD_ENV) make KVER=6.12.34+rpt-rpi-v8",
+            makefile,
+        )
+        self.assertIn('KBUILD_ENV = env "MAKEFLAGS=$${MAKEFLAGS%% -- *}"', makefile)
+        # the sources are copied once into /tmp, reachable from the chroot,
+        # and linked from there into the per-kernel build dirs
+        self.assertIn(
+            "SYNC_SRC = flock $(SRC_COPY).lock rsync -a --delete "
+            "/test/project/src/ $(SRC_COPY)/",
+            makefile,
+        )
+        self.assertIn(
+            "\t$(SYNC_SRC)\n"
+            "\tcp -rsf $(SRC_COPY)/. /tmp/drv-mydriver-6.12.34+rpt-rpi-v8/\n",
+            makefile,
+        )
+        self.assertNotIn("cp -rsf /test/project/src", makefile)
 
         # Verify DTBO targets
         self.assertIn(
@@ -678,6 +1214,16 @@ class TestBuilderUtils(unittest.TestCase):
             "staging/usr/lib/er-overlays/6.12.62+rpt-rpi-v8/mydriver.dtbo:", makefile
         )
 
+        # DTBOs are compiled once per distinct preprocessed source and
+        # hardlinked into every kernel's overlay dir
+        self.assertEqual(makefile.count("dtc  -I dts"), 3)
+        self.assertIn("sha256sum", makefile)
+        self.assertIn(
+            "ln -f $(DTBO_CACHE)/$$HASH.dtbo "
+            "staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/mydriver.dtbo",
+            makefile,
+        )
+
         # Verify .PHONY contains all targets
         self.assertIn(".PHONY:", makefile)
         # Check that PHONY line has the driver targets
@@ -694,81 +1240,1515 @@ class TestBuilderUtils(unittest.TestCase):
         self.assertNotIn("KVER ?=", makefile)
         self.assertNotIn("driver: staging/lib/modules/$(KVER)", makefile)
 
+        # probed values are resolved at generation time
+        self.assertNotIn("$(shell", makefile)
+        self.assertNotIn("ls -d1", makefile)
+        self.assertIn("VERSION := 1.0.0\n", makefile)
+
         # Verify kernel version list comment
         self.assertIn(
             "KERNEL_VERSIONS = 6.12.34+rpt-rpi-v8 6.12.62+rpt-rpi-v8 6.6.73+rpt-rpi-v8",
             makefile,
         )
 
-    def test_makefile_dts_only_no_quickdeploy(self):
+    def test_makefile_kbuild_env_drops_command_line_variables(self):
+        import shutil
+        import subprocess
+        import tempfile
         from xdrvmake.builder import render_makefile
 
-        data = {
-            "project": "myoverlay",
-            "modulename": None,  # No module for dts_only
-            "sourcedir": "src",
-            "kbuild_flags": "",
+        if shutil.which("make") is None:
+            self.skipTest("make is not installed")
+        data: dict = {
+            "project": "mydriver",
+            "modulename": "mymod",
             "maintainer": "test@example.com",
-            "description": "Test overlay",
+            "description": "Test driver",
             "version": "1.0.0",
             "architecture": "arm64",
-            "dts_only": True,  # DTS only mode
-            "blacklist": None,
-            "public_header": None,
-            "min_supported": [("linux-image-rpi-v8", "1:6.12.34+rpt-rpi-v8")],
-            "max_supported": [("linux-image-rpi-v8", "1:6.12.62+rpt-rpi-v8")],
-            "kernel_versions": [
-                "6.12.34+rpt-rpi-v8",
-                "6.12.62+rpt-rpi-v8",
-            ],
+            "min_supported": [],
+            "max_supported": [],
+            "kernel_versions": [],
             "projectroot": "/test/project",
         }
+        kbuild_env = next(
+            line
+            for line in render_makefile(data).splitlines()
+            if line.startswith("KBUILD_ENV =")
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "Makefile"), "w") as f:
+                f.write(f"{kbuild_env}\nall:\n\t+@$(KBUILD_ENV) printenv MAKEFLAGS\n")
+            for flags, expected in (
+                (["-j4", "SCHROOT_SESSION=s", "XDRVMAKE_TRACE=1"], "-j4 --jobserver"),
+                (["SCHROOT_SESSION=s"], ""),
+            ):
+                out = subprocess.run(
+                    ["make", "-s", "-C", tmp, *flags],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+                self.assertIn(expected, out)
+                self.assertNotIn("SCHROOT_SESSION", out)
+                self.assertNotIn("XDRVMAKE_TRACE", out)
+
+    def test_makefile_shared_dtbo_up_to_date(self):
+        import shutil
+        import subprocess
+        import tempfile
+        from xdrvmake.builder import render_makefile
 
-        makefile = render_makefile(data)
+        if shutil.which("make") is None or shutil.which("cpp") is None:
+            self.skipTest("make or cpp is not installed")
+        with tempfile.TemporaryDirectory() as tmp:
+            project = os.path.join(tmp, "project")
+            build = os.path.join(tmp, "build")
+            bin_dir = os.path.join(tmp, "bin")
+            for d in (project, build, bin_dir):
+                os.makedirs(d)
+            with open(os.path.join(project, "mydriver.dts"), "w") as f:
+                f.write("/dts-v1/;\n/ { };\n")
+            # dtc stand-in, copies the source
+            dtc = os.path.join(bin_dir, "dtc")
+            with open(dtc, "w") as f:
+                f.write(
+                    '#!/bin/sh\nwhile [ "$1" != -o ]; do shift; done\ncp "$3" "$2"\n'
+                )
+            os.chmod(dtc, 0o755)
+            data: dict = {
+                "project": "mydriver",
+                "modulename": "mymod",
+                "maintainer": "test@example.com",
+                "description": "Test driver",
+                "version": "1.0.0",
+                "architecture": "arm64",
+                "min_supported": [],
+                "max_supported": [],
+                "kernel_versions": ["6.1.0-rpi-v8", "6.1.0-rpi-2712"],
+                "dts_only": True,
+                "distro": "bullseye",
+                "projectroot": project,
+                "chroot_root": tmp,
+            }
+            with open(os.path.join(build, "Makefile"), "w") as f:
+                f.write(render_makefile(data))
+            targets = [
+                f"staging/usr/lib/er-overlays/{kver}/mydriver.dtbo"
+                for kver in data["kernel_versions"]
+            ]
+            env = {**os.environ, "PATH": f"{bin_dir}:{os.environ['PATH']}"}
+            for _ in range(2):
+                subprocess.run(
+                    ["make", "-s", "-C", build, *targets],
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                )
+            # both kernels share one compiled overlay
+            self.assertEqual(len(os.listdir(os.path.join(build, "dtbo-cache"))), 2)
+            # and neither is stale once built
+            for target in targets:
+                self.assertEqual(
+                    subprocess.call(["make", "-s", "-C", build, "-q", target], env=env),
+                    0,
+                    target,
+                )
 
-        # Verify version-specific driver targets exist
-        self.assertIn("driver-6.12.34+rpt-rpi-v8:", makefile)
-        self.assertIn("driver-6.12.62+rpt-rpi-v8:", makefile)
+    def test_makefile_ccache(self):
+        from xdrvmake.builder import render_makefile
 
-        # Verify NO quickdeploy targets (dts_only mode)
-        self.assertNotIn("quickdeploy-6.12.34+rpt-rpi-v8:", makefile)
-        self.assertNotIn("quickdeploy-6.12.62+rpt-rpi-v8:", makefile)
-        self.assertNotIn("rmmod", makefile)
-        self.assertNotIn("modprobe", makefile)
+        data: dict = {
+            "project": "mydriver",
+            "modulename": "mymod",
+            "maintainer": "test@example.com",
+            "description": "Test driver",
+            "version": "1.0.0",
+            "architecture": "arm64",
+            "min_supported": [],
+            "max_supported": [],
+            "kernel_versions": ["6.12.34+rpt-rpi-v8"],
+            "projectroot": "/test/project",
+        }
+        makefile = render_makefile(dict(data))
+        self.assertNotIn("ccache", makefile)
+        self.assertIn("-- $(KBUILD_ENV) make KVER=6.12.34+rpt-rpi-v8", makefile)
 
-        # Verify NO .ko file targets (dts_only)
-        self.assertNotIn("staging/lib/modules/", makefile)
-        self.assertNotIn(".ko:", makefile)
+        data.update(ccache=True, ccache_dir="/home/dev/.cache/xdrvmake/ccache")
+        makefile = render_makefile(dict(data))
+        self.assertIn("CCACHE_DIR ?= /home/dev/.cache/xdrvmake/ccache", makefile)
+        self.assertIn(
+            "KBUILD_ENV += CCACHE_DIR=$(CCACHE_DIR) PATH=/usr/lib/ccache:", makefile
+        )
+        self.assertIn("-- $(KBUILD_ENV) make KVER=6.12.34+rpt-rpi-v8", makefile)
+        self.assertIn("$(KBUILD_ENV) ccache --show-stats", makefile)
 
-        # Verify DTBO targets still exist
+    def test_setup_derived_data_ccache(self):
+        import tempfile
+        from xdrvmake.builder import setup_derived_data
+
+        with tempfile.TemporaryDirectory() as tmp:
+            args = argparse.Namespace(
+                projectdir=tmp, arch="arm64", target_dir=tmp, ccache=None
+            )
+            data: dict = {"version": "1.0.0", "ccache": True, "ccache_dir": "cc"}
+            setup_derived_data(args, data)
+            self.assertTrue(data["ccache"])
+            self.assertEqual(data["ccache_dir"], os.path.abspath("cc"))
+            args.ccache = False
+            args.ccache_dir = "/var/cache/cc"
+            setup_derived_data(args, data)
+            self.assertFalse(data["ccache"])
+            self.assertEqual(data["ccache_dir"], "/var/cache/cc")
+
+    def test_makefile_ko_cache(self):
+        from xdrvmake.builder import render_makefile
+
+        data: dict = {
+            "project": "mydriver",
+            "modulename": "mymod",
+            "maintainer": "test@example.com",
+            "description": "Test driver",
+            "version": "1.0.0",
+            "architecture": "arm64",
+            "min_supported": [],
+            "max_supported": [],
+            "kernel_versions": ["6.12.34+rpt-rpi-v8"],
+            "projectroot": "/test/project",
+        }
+        self.assertNotIn("KO_CACHE", render_makefile(dict(data)))
+
+        data.update(
+            ko_cache=True,
+            ko_cache_dir="/var/cache/ko",
+            ko_cache_size="1G",
+            ko_cache_salts={"6.12.34+rpt-rpi-v8": "abc"},
+        )
+        makefile = render_makefile(dict(data))
+        self.assertIn("-m xdrvmake.kocache --dir /var/cache/ko --max-size 1G", makefile)
+        # a hit restores the module before the buildroot is entered
         self.assertIn(
-            "staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/myoverlay.dtbo:", makefile
+            "+$(KO_CACHE) fetch --source /test/project/src --salt abc $@ || {",
+            makefile,
+        )
+        self.assertLess(
+            makefile.index("$(KO_CACHE) fetch"), makefile.index("$(SCHROOT) -u root")
         )
         self.assertIn(
-            "staging/usr/lib/er-overlays/6.12.62+rpt-rpi-v8/myoverlay.dtbo:", makefile
+            "$(KO_CACHE) store --source /test/project/src --salt abc $@ ; }", makefile
+        )
+        # only a real build refreshes the depfile
+        self.assertLess(
+            makefile.index("$(SCHROOT) -u root"), makefile.index("$(DEPFILE) --search")
         )
 
-        # Verify driver targets depend only on DTBO (not .ko)
+    def test_makefile_depfiles(self):
+        from xdrvmake.builder import render_makefile
+
+        data: dict = {
+            "project": "mydriver",
+            "modulename": "mymod",
+            "maintainer": "test@example.com",
+            "description": "Test driver",
+            "version": "1.0.0",
+            "architecture": "arm64",
+            "min_supported": [],
+            "max_supported": [],
+            "kernel_versions": ["6.12.34+rpt-rpi-v8"],
+            "kernel_common_headers": {
+                "6.12.34+rpt-rpi-v8": "/chroot/usr/src/linux-headers-6.12.34+rpt-common-rpi"
+            },
+            "projectroot": "/test/project",
+            "chroot_root": "/chroot",
+        }
+        makefile = render_makefile(data)
         self.assertIn(
-            "driver-6.12.34+rpt-rpi-v8: staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/myoverlay.dtbo",
+            "-m xdrvmake.depfile --root /chroot "
+            "--source-copy /tmp/drv-mydriver-src /test/project/src\n",
+            makefile,
+        )
+        self.assertIn(
+            "\t$(DEPFILE) --search /chroot/usr/src/linux-headers-6.12.34+rpt-rpi-v8 "
+            "--search /chroot/usr/src/linux-headers-6.12.34+rpt-common-rpi "
+            "-o deps/6.12.34+rpt-rpi-v8.d /tmp/drv-mydriver-6.12.34+rpt-rpi-v8 $@\n",
             makefile,
         )
+        # included after every rule, so "all" stays the default goal
+        self.assertTrue(makefile.rstrip().endswith("-include $(wildcard deps/*.d)"))
 
-        # Verify aggregate all-drivers target
-        self.assertIn("all-drivers:", makefile)
-        self.assertIn("driver-6.12.34+rpt-rpi-v8", makefile)
-        self.assertIn("driver-6.12.62+rpt-rpi-v8", makefile)
+    def test_makefile_overlay_headers(self):
+        from xdrvmake.builder import render_makefile
 
-        # Verify .PHONY does NOT contain quickdeploy targets
-        phony_lines = [
-            line for line in makefile.split("\n") if line.startswith(".PHONY:")
-        ]
-        self.assertTrue(len(phony_lines) > 0)
-        phony_content = " ".join(phony_lines)
-        self.assertIn("driver-6.12.34+rpt-rpi-v8", phony_content)
+        data: dict = {
+            "project": "mydriver",
+            "modulename": "mymod",
+            "maintainer": "test@example.com",
+            "description": "Test driver",
+            "version": "1.0.0",
+            "architecture": "arm64",
+            "min_supported": [],
+            "max_supported": [],
+            "kernel_versions": ["6.12.34+rpt-rpi-v8"],
+            "kernel_common_headers": {},
+            "projectroot": "/test/project",
+            "chroot_root": "/chroot",
+        }
+        # the device tree includes come from the configured buildroot
+        makefile = render_makefile(dict(data))
+        self.assertIn(
+            "-I$(wildcard /chroot/usr/src/*6.12.34+rpt*-common-rpi)/include "
+            "-I/chroot/usr/src/linux-headers-6.12.34+rpt-rpi-v8/include ",
+            makefile,
+        )
+        makefile = render_makefile(dict(data, distro="bullseye"))
+        self.assertIn(
+            "-I/chroot/usr/src/linux-headers-6.12.34+rpt-rpi-v8/include ", makefile
+        )
+        self.assertNotIn("/var/chroot", makefile)
+
+    def test_compute_ko_cache_salts(self):
+        import tempfile
+        from xdrvmake.builder import compute_ko_cache_salts, setup_derived_data
+
+        status = textwrap.dedent(
+            """\
+            Package: linux-headers-6.12.34+rpt-rpi-v8
+            Status: install ok installed
+            Version: 1:6.12.34-1+rpt1
+
+            Package: gcc-aarch64-linux-gnu
+            Status: install ok installed
+            Version: 4:12.2.0-3
+
+            Package: gcc-doc
+            Status: deinstall ok config-files
+            Version: 1
+            """
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(f"{tmp}/var/lib/dpkg")
+            with open(f"{tmp}/var/lib/dpkg/status", "w") as f:
+                f.write(status)
+            args = argparse.Namespace(
+                chroot_root=tmp, projectdir=tmp, arch="arm64", target_dir=tmp
+            )
+            data: dict = {"version": "1.0.0", "ko_cache": True}
+            setup_derived_data(args, data)
+            self.assertEqual(data["ko_cache_size"], "2G")
+            data.update(modulename="m", kernel_versions=["6.12.34+rpt-rpi-v8"])
+            salts = compute_ko_cache_salts(args, data)
+            self.assertEqual(list(salts), ["6.12.34+rpt-rpi-v8"])
+            self.assertEqual(salts, compute_ko_cache_salts(args, data))
+            data["kbuild_flags"] = "DEBUG=1"
+            self.assertNotEqual(salts, compute_ko_cache_salts(args, data))
+            del data["kbuild_flags"]
+            # a toolchain upgrade changes the key, uninstalled packages don't count
+            with open(f"{tmp}/var/lib/dpkg/status", "w") as f:
+                f.write(status.replace("Version: 1\n", "Version: 2\n"))
+            self.assertEqual(salts, compute_ko_cache_salts(args, data))
+            with open(f"{tmp}/var/lib/dpkg/status", "w") as f:
+                f.write(status.replace("12.2.0-3", "12.2.0-4"))
+            self.assertNotEqual(salts, compute_ko_cache_salts(args, data))
+
+    def test_split_packages(self):
+        import tempfile
+        from xdrvmake.builder import create_stating, load_manifest_data, render_makefile
+
+        data: dict = {
+            "project": "mydriver",
+            "modulename": "mymod",
+            "maintainer": "test@example.com",
+            "description": "Test driver",
+            "version": "1.0.0",
+            "architecture": "arm64",
+            "projectroot": "/test/project",
+            "split_packages": True,
+        }
+        load_manifest_data(
+            data, {"rpi-v8": ["6.12.34+rpt-rpi-v8", "6.12.62+rpt-rpi-v8"]}
+        )
+        makefile = render_makefile(dict(data))
+        self.assertIn(
+            "PACKAGES = mydriver_$(VERSION)-1_$(ARCH).deb "
+            "mydriver-6.12.34+rpt-rpi-v8_$(VERSION)-1_$(ARCH).deb "
+            "mydriver-6.12.62+rpt-rpi-v8_$(VERSION)-1_$(ARCH).deb",
+            makefile,
+        )
+        self.assertIn("all: $(PACKAGES)", makefile)
+        self.assertIn(
+            "mydriver-6.12.34+rpt-rpi-v8_$(VERSION)-1_$(ARCH).deb : "
+            "driver-6.12.34+rpt-rpi-v8 packages/mydriver-6.12.34+rpt-rpi-v8/DEBIAN/*",
+            makefile,
+        )
+        self.assertIn(
+            "ln -f staging/lib/modules/6.12.34+rpt-rpi-v8/mymod.ko "
+            "packages/mydriver-6.12.34+rpt-rpi-v8/lib/modules/6.12.34+rpt-rpi-v8/",
+            makefile,
+        )
+        # the meta package doesn't wait for the drivers, it has no artifacts
+        self.assertIn("mydriver_$(VERSION)-1_$(ARCH).deb : staging/DEBIAN/*", makefile)
+        self.assertIn(
+            "dpkg-deb --root-owner-group --build packages/mydriver $@", makefile
+        )
+        self.assertIn("/tmp/mydriver-$${KVER}_$(VERSION)-1_$(ARCH).deb", makefile)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                create_stating(argparse.Namespace(), data)
+                root = "packages/mydriver-6.12.62+rpt-rpi-v8/DEBIAN"
+                self.assertEqual(
+                    sorted(os.listdir(root)), ["control", "postinst", "triggers"]
+                )
+                with open(f"{root}/control") as f:
+                    control = f.read()
+                self.assertIn("Package: mydriver-6.12.62+rpt-rpi-v8\n", control)
+                self.assertIn("Depends: mydriver (= 1.0.0)\n", control)
+                with open(f"{root}/postinst") as f:
+                    self.assertIn("depmod -a 6.12.62+rpt-rpi-v8", f.read())
+                with open("staging/DEBIAN/control") as f:
+                    control = f.read()
+                # the meta package carries the supported kernel range
+                self.assertIn("Package: mydriver\n", control)
+                self.assertIn("linux-image-rpi-v8 (>=1:6.12.34+rpt-rpi-v8)", control)
+                self.assertIn("linux-image-rpi-v8 (>>1:6.12.62+rpt-rpi-v8)", control)
+                with open("staging/DEBIAN/postinst") as f:
+                    self.assertNotIn("exit 1", f.read())
+            finally:
+                os.chdir(cwd)
+
+    def test_expand_project_dirs(self):
+        import tempfile
+        from xdrvmake.builder import expand_project_dirs
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("drv-a", "drv-b", "notes"):
+                os.makedirs(os.path.join(tmp, name))
+            for name in ("drv-a", "drv-b"):
+                open(os.path.join(tmp, name, "drivercfg.yaml"), "w").close()
+            workspace = os.path.join(tmp, "workspace")
+            with open(workspace, "w") as f:
+                f.write("# all drivers\ndrv-*\nnotes  # no drivercfg, but explicit\n")
+            args = argparse.Namespace(
+                projectdirs=[os.path.join(tmp, "drv-b")], workspace=workspace
+            )
+            self.assertEqual(
+                expand_project_dirs(args),
+                [os.path.join(tmp, name) for name in ("drv-b", "drv-a", "notes")],
+            )
+
+    def test_configure_workspace(self):
+        import json
+        import tempfile
+        import yaml
+        from xdrvmake import builder
+
+        def fake_install_kernel_headers(args, data):
+            builder.load_manifest_data(
+                data, {"rpi-v8": ["6.12.34+rpt-rpi-v8", "6.12.62+rpt-rpi-v8"]}
+            )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            projectdirs = []
+            for name in ("drva", "drvb"):
+                projectdir = os.path.join(tmp, "src", name)
+                os.makedirs(projectdir)
+                with open(os.path.join(projectdir, "drivercfg.yaml"), "w") as f:
+                    yaml.safe_dump(
+                        {
+                            "project": name,
+                            "modulename": f"{name}mod",
+                            "maintainer": "test@example.com",
+                            "description": "Test driver",
+                            "version": "1.0.0",
+                        },
+                        f,
+                    )
+                projectdirs.append(projectdir)
+            with open(os.path.join(tmp, "target"), "w") as f:
+                f.write("VERSION_CODENAME=bookworm\n")
+            build = os.path.join(tmp, "build")
+            os.makedirs(build)
+            args = argparse.Namespace(
+                build=None,
+                projectdir=projectdirs[0],
+                projectdirs=projectdirs,
+                chroot_root=tmp,
+                target_dir=tmp,
+                arch="arm64",
+                template_cache=None,
+            )
+            cwd = os.getcwd()
+            os.chdir(build)
+            try:
+                with patch(
+                    "xdrvmake.builder.install_kernel_headers",
+                    side_effect=fake_install_kernel_headers,
+                ) as install:
+                    builder.run(args)
+            finally:
+                os.chdir(cwd)
+            # the headers are discovered once for all projects
+            self.assertEqual(install.call_count, 1)
+            with open(os.path.join(build, "Makefile")) as f:
+                makefile = f.read()
+            self.assertIn("PROJECTS = drva drvb", makefile)
+            self.assertIn("\t+$(MAKE) -C $@ all", makefile)
+            self.assertIn("drvb/%: FORCE\n\t+$(MAKE) -C drvb $*", makefile)
+            self.assertEqual(
+                builder.read_makefile_kernel_versions(build),
+                ["6.12.34+rpt-rpi-v8", "6.12.62+rpt-rpi-v8"],
+            )
+            for name in ("drva", "drvb"):
+                with open(os.path.join(build, name, "Makefile")) as f:
+                    self.assertIn(f"/src/{name}/src/*.c", f.read())
+                self.assertTrue(
+                    os.path.exists(os.path.join(build, name, "staging/DEBIAN/control"))
+                )
+            with open(os.path.join(build, builder.build_graph_filename)) as f:
+                graph = json.load(f)
+            self.assertEqual(
+                graph["kernels"]["6.12.34+rpt-rpi-v8"],
+                [
+                    "drva/staging/lib/modules/6.12.34+rpt-rpi-v8/drvamod.ko",
+                    "drva/staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/drva.dtbo",
+                    "drvb/staging/lib/modules/6.12.34+rpt-rpi-v8/drvbmod.ko",
+                    "drvb/staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/drvb.dtbo",
+                ],
+            )
+
+    def test_configure_workspace_relative_dirs(self):
+        import json
+        import tempfile
+        import yaml
+        from xdrvmake import builder
+
+        def fake_install_kernel_headers(args, data):
+            builder.load_manifest_data(data, {"rpi-v8": ["6.12.34+rpt-rpi-v8"]})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = os.path.realpath(tmp)
+            for name in ("drva", "drvb"):
+                projectdir = os.path.join(tmp, "drivers", name)
+                os.makedirs(projectdir)
+                with open(os.path.join(projectdir, "drivercfg.yaml"), "w") as f:
+                    yaml.safe_dump(
+                        {
+                            "project": name,
+                            "modulename": f"{name}mod",
+                            "maintainer": "test@example.com",
+                            "description": "Test driver",
+                            "version": "1.0.0",
+                        },
+                        f,
+                    )
+            with open(os.path.join(tmp, "target"), "w") as f:
+                f.write("VERSION_CODENAME=bookworm\n")
+            build = os.path.join(tmp, "out")
+            os.makedirs(build)
+            # every path relative to the output directory
+            args = argparse.Namespace(
+                build=None,
+                projectdir="../drivers/drva",
+                projectdirs=["../drivers/drva", "../drivers/drvb"],
+                chroot_root="..",
+                target_dir="..",
+                arch="arm64",
+                template_cache=None,
+            )
+            cwd = os.getcwd()
+            os.chdir(build)
+            try:
+                with patch(
+                    "xdrvmake.builder.install_kernel_headers",
+                    side_effect=fake_install_kernel_headers,
+                ):
+                    builder.run(args)
+            finally:
+                os.chdir(cwd)
+            for name in ("drva", "drvb"):
+                with open(os.path.join(build, name, "Makefile")) as f:
+                    self.assertIn(f"{tmp}/drivers/{name}/src/*.c", f.read())
+            with open(os.path.join(build, builder.build_graph_filename)) as f:
+                graph = json.load(f)
+            self.assertEqual(
+                sorted(graph["sources"]),
+                [
+                    f"{tmp}/drivers/drva/drva.dts",
+                    f"{tmp}/drivers/drva/src",
+                    f"{tmp}/drivers/drvb/drvb.dts",
+                    f"{tmp}/drivers/drvb/src",
+                ],
+            )
+
+    def test_makefile_dts_only_no_quickdeploy(self):
+        from xdrvmake.builder import render_makefile
+
+        data = {
+            "project": "myoverlay",
+            "modulename": None,  # No module for dts_only
+            "sourcedir": "src",
+            "kbuild_flags": "",
+            "maintainer": "test@example.com",
+            "description": "Test overlay",
+            "version": "1.0.0",
+            "architecture": "arm64",
+            "dts_only": True,  # DTS only mode
+            "blacklist": None,
+            "public_header": None,
+            "min_supported": [("linux-image-rpi-v8", "1:6.12.34+rpt-rpi-v8")],
+            "max_supported": [("linux-image-rpi-v8", "1:6.12.62+rpt-rpi-v8")],
+            "kernel_versions": [
+                "6.12.34+rpt-rpi-v8",
+                "6.12.62+rpt-rpi-v8",
+            ],
+            "projectroot": "/test/project",
+        }
+
+        makefile = render_makefile(data)
+
+        # Verify version-specific driver targets exist
+        self.assertIn("driver-6.12.34+rpt-rpi-v8:", makefile)
+        self.assertIn("driver-6.12.62+rpt-rpi-v8:", makefile)
+
+        # Verify NO quickdeploy targets (dts_only mode)
+        self.assertNotIn("quickdeploy-6.12.34+rpt-rpi-v8:", makefile)
+        self.assertNotIn("quickdeploy-6.12.62+rpt-rpi-v8:", makefile)
+        self.assertNotIn("rmmod", makefile)
+        self.assertNotIn("modprobe", makefile)
+
+        # Verify NO .ko file targets (dts_only)
+        self.assertNotIn("staging/lib/modules/", makefile)
+        self.assertNotIn(".ko:", makefile)
+
+        # Verify DTBO targets still exist
+        self.assertIn(
+            "staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/myoverlay.dtbo:", makefile
+        )
+        self.assertIn(
+            "staging/usr/lib/er-overlays/6.12.62+rpt-rpi-v8/myoverlay.dtbo:", makefile
+        )
+
+        # Verify driver targets depend only on DTBO (not .ko)
+        self.assertIn(
+            "driver-6.12.34+rpt-rpi-v8: staging/usr/lib/er-overlays/6.12.34+rpt-rpi-v8/myoverlay.dtbo",
+            makefile,
+        )
+
+        # Verify aggregate all-drivers target
+        self.assertIn("all-drivers:", makefile)
+        self.assertIn("driver-6.12.34+rpt-rpi-v8", makefile)
+        self.assertIn("driver-6.12.62+rpt-rpi-v8", makefile)
+
+        # Verify .PHONY does NOT contain quickdeploy targets
+        phony_lines = [
+            line for line in makefile.split("\n") if line.startswith(".PHONY:")
+        ]
+        self.assertTrue(len(phony_lines) > 0)
+        phony_content = " ".join(phony_lines)
+        self.assertIn("driver-6.12.34+rpt-rpi-v8", phony_content)
         self.assertNotIn("quickdeploy", phony_content)
 
 
+class TestTrace(unittest.TestCase):
+    def tearDown(self):
+        from xdrvmake import trace
+
+        trace._events = None
+
+    def test_spans_disabled(self):
+        from xdrvmake import trace
+
+        with trace.span("noop"), trace.make_tracing(["k"]) as make_args:
+            self.assertEqual(make_args, [])
+        self.assertFalse(trace.enabled())
+
+    def test_make_target_spans(self):
+        import json
+        import tempfile
+        from xdrvmake import trace
+        from xdrvmake.builder import exec_make
+
+        makefile = textwrap.dedent(
+            """\
+            KERNEL_VERSIONS = 6.1.0-rpi-v8 6.1.1-rpi-v8
+            ifdef XDRVMAKE_TRACE
+            export XDRVMAKE_TRACE_TARGET = $@
+            endif
+            all: out/6.1.0-rpi-v8/m.ko out/6.1.1-rpi-v8/m.ko
+            \t@true
+            out/%/m.ko:
+            \t@sleep 0.01
+            \t@echo $@
+            """
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "Makefile"), "w") as f:
+                f.write(makefile)
+            trace.start()
+            with trace.span("configure step", detail="x"):
+                pass
+            exec_make(argparse.Namespace(build=tmp, jobs=2), "all")
+            trace.write(os.path.join(tmp, "trace.json"))
+            with open(os.path.join(tmp, "trace.json")) as f:
+                events = json.load(f)["traceEvents"]
+        spans = {e["name"]: e for e in events if e["ph"] == "X"}
+        self.assertEqual(spans["configure step"]["args"], {"detail": "x"})
+        self.assertIn("make all", spans)
+        ko = spans["out/6.1.0-rpi-v8/m.ko"]
+        self.assertEqual(ko["args"], {"kernel": "6.1.0-rpi-v8", "exit_code": 0})
+        self.assertGreaterEqual(ko["dur"], 10000)
+        tracks = {
+            e["tid"]: e["args"]["name"] for e in events if e["name"] == "thread_name"
+        }
+        self.assertEqual(tracks[ko["tid"]], "6.1.0-rpi-v8")
+        self.assertEqual(tracks[spans["out/6.1.1-rpi-v8/m.ko"]["tid"]], "6.1.1-rpi-v8")
+
+
+class TestScheduler(unittest.TestCase):
+    def test_run_graph_failure_skips_dependents(self):
+        import threading
+        from xdrvmake import scheduler
+
+        tasks = [
+            scheduler.Task("a.ko", "k1"),
+            scheduler.Task("a.dtbo", "k1"),
+            scheduler.Task("b.ko", "k2"),
+            scheduler.Task("b.dtbo", "k2"),
+        ]
+        tasks.append(scheduler.Task("all", deps=[t.name for t in tasks]))
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def run_task(task):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            try:
+                if task.name == "b.ko":
+                    raise RuntimeError("compile error")
+                return scheduler.UP_TO_DATE if task.label == "k1" else scheduler.BUILT
+            finally:
+                with lock:
+                    active[0] -= 1
+
+        self.assertFalse(scheduler.run_graph(tasks, run_task, jobs=2))
+        states = {t.name: t.status for t in tasks}
+        self.assertEqual(
+            states,
+            {
+                "a.ko": scheduler.UP_TO_DATE,
+                "a.dtbo": scheduler.UP_TO_DATE,
+                "b.ko": scheduler.FAILED,
+                "b.dtbo": scheduler.BUILT,
+                "all": scheduler.SKIPPED,
+            },
+        )
+        self.assertLessEqual(active[1], 2)
+        summary = scheduler.format_summary(tasks)
+        self.assertIn("failed", summary)
+        self.assertIn("compile error", summary)
+
+    def test_run_graph_rejects_unknown_dependency(self):
+        from xdrvmake import scheduler
+
+        with self.assertRaises(ValueError):
+            scheduler.run_graph(
+                [scheduler.Task("all", deps=["missing"])], lambda t: "", jobs=1
+            )
+
+    def test_build_driver_python_engine(self):
+        import json
+        import tempfile
+        from xdrvmake import builder
+
+        makefile = textwrap.dedent(
+            """\
+            all: out/k1.ko out/k2.ko
+            \t@touch all.done
+            out/%.ko:
+            \t@mkdir -p out
+            \ttouch $@
+            """
+        )
+        data = {
+            "project": "p",
+            "modulename": "m",
+            "version": "1.0",
+            "architecture": "arm64",
+            "kernel_versions": ["k1"],
+            "projectroot": "/proj",
+        }
+        self.assertEqual(
+            builder.compute_build_graph(data),
+            {
+                "kernels": {
+                    "k1": [
+                        "staging/lib/modules/k1/m.ko",
+                        "staging/usr/lib/er-overlays/k1/p.dtbo",
+                    ]
+                },
+                "sources": {
+                    "/proj/p.dts": ["staging/usr/lib/er-overlays/k1/p.dtbo"],
+                    "/proj/src": ["staging/lib/modules/k1/m.ko"],
+                },
+                "packages": ["p_1.0-1_arm64.deb"],
+                "final": "all",
+            },
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "Makefile"), "w") as f:
+                f.write(makefile)
+            with open(os.path.join(tmp, builder.build_graph_filename), "w") as f:
+                json.dump(
+                    {
+                        "kernels": {"k1": ["out/k1.ko"], "k2": ["out/k2.ko"]},
+                        "final": "all",
+                    },
+                    f,
+                )
+            args = argparse.Namespace(
+                build=tmp,
+                jobs=2,
+                engine="python",
+                chroot_name="buildroot",
+                schroot_session="sess",
+            )
+            builder.build_driver(args)
+            self.assertTrue(os.path.exists(os.path.join(tmp, "out", "k2.ko")))
+            self.assertTrue(os.path.exists(os.path.join(tmp, "all.done")))
+            os.remove(os.path.join(tmp, "out", "k1.ko"))
+            with open(os.path.join(tmp, "Makefile"), "a") as f:
+                f.write("out/k1.ko:\n\tfalse\n")
+            with self.assertRaises(RuntimeError) as ctx:
+                builder.build_driver(args)
+            self.assertIn("out/k1.ko", str(ctx.exception))
+
+    def test_build_driver_python_engine_splits_jobs(self):
+        import json
+        import tempfile
+        from xdrvmake import builder
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, builder.build_graph_filename), "w") as f:
+                json.dump(
+                    {
+                        "kernels": {"k1": ["out/k1.ko"], "k2": ["out/k2.ko"]},
+                        "final": "all",
+                    },
+                    f,
+                )
+            args = argparse.Namespace(
+                build=tmp, jobs=8, engine="python", schroot_session="sess"
+            )
+            with patch("subprocess.call", return_value=1), patch(
+                "xdrvmake.builder.exec_command", return_value=""
+            ) as exec_command:
+                builder.build_driver_scheduled(args)
+        cmds = [c.args[0] for c in exec_command.call_args_list]
+        # two kernels share the budget of 8 jobs, the final target gets the same share
+        self.assertEqual(len(cmds), 3)
+        for cmd in cmds:
+            self.assertEqual(cmd[3:5], ["-j", "4"])
+
+
+class TestKoCache(unittest.TestCase):
+    def test_parse_size(self):
+        from xdrvmake.kocache import parse_size
+
+        self.assertEqual(parse_size("100"), 100)
+        self.assertEqual(parse_size("2G"), 2 << 30)
+        self.assertEqual(parse_size("1.5MiB"), 3 << 19)
+
+    def test_fetch_store(self):
+        import tempfile
+        from xdrvmake import kocache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+            os.makedirs(os.path.join(src, "sub"))
+            with open(os.path.join(src, "sub", "a.c"), "w") as f:
+                f.write("int a;")
+            cache = os.path.join(tmp, "cache")
+            module = os.path.join(tmp, "m.ko")
+            with open(module, "w") as f:
+                f.write("module")
+            key = kocache.cache_key(src, "salt")
+            out = os.path.join(tmp, "out.ko")
+            self.assertFalse(kocache.fetch(cache, key, out))
+            kocache.store(cache, key, module, 1 << 20)
+            self.assertTrue(kocache.fetch(cache, key, out))
+            with open(out) as f:
+                self.assertEqual(f.read(), "module")
+            # hidden files (kbuild .cmd files, .git) don't change the key
+            with open(os.path.join(src, "sub", ".a.o.cmd"), "w") as f:
+                f.write("x")
+            self.assertEqual(kocache.cache_key(src, "salt"), key)
+            self.assertNotEqual(kocache.cache_key(src, "other"), key)
+            with open(os.path.join(src, "sub", "a.c"), "a") as f:
+                f.write("int b;")
+            self.assertNotEqual(kocache.cache_key(src, "salt"), key)
+
+    def test_prune_lru(self):
+        import tempfile
+        from xdrvmake import kocache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            module = os.path.join(tmp, "m.ko")
+            with open(module, "w") as f:
+                f.write("x" * 100)
+            cache = os.path.join(tmp, "cache")
+            keys = [f"{i:02x}" * 32 for i in range(3)]
+            for i, key in enumerate(keys):
+                kocache.store(cache, key, module, 1 << 20)
+                os.utime(kocache.entry_path(cache, key), (1000 + i, 1000 + i))
+            # fetching the oldest entry makes it the most recently used
+            self.assertTrue(kocache.fetch(cache, keys[0], os.path.join(tmp, "o")))
+            removed = kocache.prune(cache, 250)
+            self.assertEqual(removed, [kocache.entry_path(cache, keys[1])])
+            self.assertEqual(kocache.stats(cache)["entries"], 2)
+            self.assertEqual(kocache.stats(cache)["size"], 200)
+
+    def test_cache_command(self):
+        import io
+        import tempfile
+        from contextlib import redirect_stdout
+        from xdrvmake import builder
+
+        with tempfile.TemporaryDirectory() as tmp:
+            out = io.StringIO()
+            with patch("sys.argv", ["xdrvmake", "cache", "--dir", tmp, "stats"]):
+                with redirect_stdout(out), self.assertRaises(SystemExit) as ctx:
+                    builder.main()
+            self.assertEqual(ctx.exception.code, 0)
+            self.assertIn("entries:   0", out.getvalue())
+
+
+class FakeTransport:
+    """
+    Records the calls, fakes each device as a dict of paths to contents and
+    unpacks copied tar bundles into it when a script runs.
+    """
+
+    def __init__(self, failing=(), delay=0.02):
+        import threading
+
+        self.failing = set(failing)
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.devices: dict = {}
+        self.bundles: dict = {}
+
+    def copy(self, host, path, remote_dir):
+        import time
+
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.calls.append(("copy", host, path, remote_dir))
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if host in self.failing:
+            raise ConnectionError(f"{host} unreachable")
+        if path.endswith(".tar"):
+            with open(path, "rb") as f:
+                self.bundles[host] = f.read()
+
+    def run(self, host, script):
+        import io
+        import tarfile
+
+        with self.lock:
+            self.calls.append(("run", host, script))
+        bundle = self.bundles.pop(host, None)
+        if bundle is not None:
+            device = self.devices.setdefault(host, {})
+            with tarfile.open(fileobj=io.BytesIO(bundle)) as tar:
+                for member in tar.getmembers():
+                    f = tar.extractfile(member)
+                    if f is not None:
+                        device["/" + member.name] = f.read().decode()
+
+    def read(self, host, path):
+        with self.lock:
+            self.calls.append(("read", host, path))
+        return self.devices.get(host, {}).get(path, "")
+
+
+class TestDepfile(unittest.TestCase):
+    def test_module_deps(self):
+        import pathlib
+        import shutil
+        import tempfile
+        from xdrvmake import depfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = os.path.realpath(tmp)
+            src, build, root = (os.path.join(tmp, d) for d in ("src", "build", "root"))
+            headers = f"{root}/usr/src/linux-headers-k1"
+            for path in (
+                f"{src}/m.c",
+                f"{src}/sub/x.h",
+                f"{headers}/include/generated/autoconf.h",
+                f"{root}/usr/include/linux/types.h",
+            ):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                pathlib.Path(path).touch()
+            # the symlink farm kbuild ran in, linking to a copy of the tree,
+            # with a generated file
+            copy = os.path.join(tmp, "copy")
+            shutil.copytree(src, copy)
+            os.makedirs(f"{build}/sub")
+            os.symlink(f"{copy}/m.c", f"{build}/m.c")
+            os.symlink(f"{copy}/sub/x.h", f"{build}/sub/x.h")
+            pathlib.Path(f"{build}/m.mod.c").touch()
+            pathlib.Path(f"{build}/.m.o.cmd").write_text(
+                textwrap.dedent(
+                    f"""\
+                    cmd_m.o := gcc -c -o m.o m.c
+                    source_m.o := {build}/m.c
+
+                    deps_m.o := \\
+                      sub/x.h \\
+                        $(wildcard include/config/FOO) \\
+                      include/generated/autoconf.h \\
+                      /usr/include/linux/types.h \\
+                      /usr/include/linux/removed.h \\
+                      m.mod.c \\
+
+                    m.o: $(deps_m.o)
+
+                    $(deps_m.o):
+                    """
+                )
+            )
+            deps = depfile.module_deps(build, root, [headers], (copy, src))
+            self.assertEqual(
+                deps,
+                [
+                    f"{root}/usr/include/linux/types.h",
+                    f"{headers}/include/generated/autoconf.h",
+                    f"{src}/m.c",
+                    f"{src}/sub/x.h",
+                ],
+            )
+
+            output = os.path.join(tmp, "deps", "k1.d")
+            argv = [
+                "--root",
+                root,
+                "--search",
+                headers,
+                "--source-copy",
+                copy,
+                src,
+                "-o",
+                output,
+                build,
+                "m.ko",
+            ]
+            self.assertEqual(depfile.main(argv), 0)
+            with open(output) as f:
+                text = f.read()
+        self.assertEqual(text, depfile.format_depfile("m.ko", deps))
+        self.assertTrue(text.startswith(f"m.ko: \\\n {root}/usr/include/linux/types.h"))
+        self.assertIn(f"\n\n{src}/sub/x.h:\n", text)
+
+    def test_format_depfile_escapes(self):
+        from xdrvmake import depfile
+
+        self.assertEqual(
+            depfile.format_depfile("m.ko", ["/a b/$x#.h"]),
+            "m.ko: \\\n /a\\ b/$$x\\#.h\n\n/a\\ b/$$x\\#.h:\n",
+        )
+
+
+class TestFleetDeploy(unittest.TestCase):
+    def test_deploy_fleet_bounded_concurrency(self):
+        from xdrvmake import deploy, scheduler
+
+        transport = FakeTransport(failing={"pi-3"})
+        hosts = [f"pi-{i}" for i in range(10)]
+        tasks = deploy.deploy_fleet(
+            hosts + ["pi-0"], "/b/mydriver_1.0-1_arm64.deb", transport, 3
+        )
+        self.assertEqual([t.name for t in tasks], hosts)
+        self.assertLessEqual(transport.max_active, 3)
+        self.assertGreater(transport.max_active, 1)
+        status = {t.name: t.status for t in tasks}
+        self.assertEqual(status.pop("pi-3"), scheduler.FAILED)
+        self.assertEqual(set(status.values()), {scheduler.DONE})
+        runs = [c for c in transport.calls if c[0] == "run"]
+        self.assertEqual(len(runs), 9)
+        self.assertIn(
+            "sudo dpkg --force-all -i /tmp/mydriver_1.0-1_arm64.deb", runs[0][2]
+        )
+        self.assertIn("dtoverlay=mydriver", runs[0][2])
+        summary = scheduler.format_summary(tasks)
+        self.assertIn("pi-3 unreachable", summary)
+
+    def test_deploy_command(self):
+        import io
+        import tempfile
+        from contextlib import redirect_stderr, redirect_stdout
+        from xdrvmake import builder
+
+        with tempfile.TemporaryDirectory() as tmp:
+            inventory = os.path.join(tmp, "hosts")
+            with open(inventory, "w") as f:
+                f.write("# lab A\npi@board-1\n\npi@board-2  # flaky\n")
+            argv = ["xdrvmake", "deploy", "--build", tmp, "-i", inventory, "pi@x"]
+            err = io.StringIO()
+            with patch("sys.argv", argv), redirect_stderr(err):
+                with self.assertRaises(FileNotFoundError):
+                    builder.main()
+            open(os.path.join(tmp, "mydriver_1.0-1_arm64.deb"), "w").close()
+            transport = FakeTransport(failing={"pi@board-2"}, delay=0)
+            out = io.StringIO()
+            with patch("sys.argv", argv), patch(
+                "xdrvmake.deploy.SshTransport", return_value=transport
+            ), redirect_stdout(out), redirect_stderr(err):
+                with self.assertRaises(SystemExit) as ctx:
+                    builder.main()
+            self.assertEqual(ctx.exception.code, 1)
+            self.assertEqual(
+                sorted(c[1] for c in transport.calls if c[0] == "copy"),
+                ["pi@board-1", "pi@board-2", "pi@x"],
+            )
+            self.assertIn("done", out.getvalue())
+            self.assertIn("1 of 3 hosts failed", err.getvalue())
+
+
+class TestDeltaDeploy(unittest.TestCase):
+    def write_staging(self, staging, files):
+        for path, content in files.items():
+            full = os.path.join(staging, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full, "w") as f:
+                f.write(content)
+
+    def test_compute_delta(self):
+        from xdrvmake.deploy import compute_delta, format_manifest, parse_manifest
+
+        remote = {"lib/modules/a/m.ko": "1" * 64, "lib/modules/b/m.ko": "2" * 64}
+        self.assertEqual(parse_manifest(format_manifest(remote) + "junk\n"), remote)
+        local = {"lib/modules/a/m.ko": "1" * 64, "lib/modules/c/m.ko": "3" * 64}
+        self.assertEqual(
+            compute_delta(local, remote),
+            (["lib/modules/c/m.ko"], ["lib/modules/b/m.ko"]),
+        )
+
+    def test_delta_deploy(self):
+        import tempfile
+        from xdrvmake import deploy, scheduler
+
+        with tempfile.TemporaryDirectory() as tmp:
+            staging = os.path.join(tmp, "staging")
+            ko = "lib/modules/6.12.34+rpt-rpi-v8/mymod.ko"
+            dtbo = "usr/lib/er-overlays/6.12.34+rpt-rpi-v8/mydriver.dtbo"
+            other = "lib/modules/6.12.62+rpt-rpi-v8/mymod.ko"
+            self.write_staging(staging, {ko: "ko v1", dtbo: "dtbo v1", other: "ko"})
+            package = os.path.join(tmp, "mydriver_1.0-1_arm64.deb")
+            transport = FakeTransport(delay=0)
+
+            # no manifest on the device yet, the full package is installed
+            (task,) = deploy.deploy_fleet(["pi"], package, transport, 1, staging, True)
+            self.assertEqual(task.status, scheduler.DONE)
+            self.assertIn(("copy", "pi", package, "/tmp"), transport.calls)
+            manifest_path = "/var/lib/xdrvmake/mydriver.sha256"
+            manifest = transport.devices["pi"][manifest_path]
+            self.assertEqual(
+                deploy.parse_manifest(manifest), deploy.staged_manifest(staging)
+            )
+            self.assertIn(f"  {ko}\n", manifest)
+            # the full package carries the artifacts, the bundle only the manifest
+            self.assertEqual(list(transport.devices["pi"]), [manifest_path])
+
+            # nothing changed
+            transport.calls.clear()
+            (task,) = deploy.deploy_fleet(["pi"], package, transport, 1, staging, True)
+            self.assertEqual(task.status, scheduler.UP_TO_DATE)
+            self.assertEqual([c[0] for c in transport.calls], ["read"])
+
+            # one module changed, one kernel dropped
+            self.write_staging(staging, {ko: "ko v2"})
+            os.remove(os.path.join(staging, other))
+            transport.calls.clear()
+            (task,) = deploy.deploy_fleet(["pi"], package, transport, 1, staging, True)
+            self.assertEqual(task.status, scheduler.DONE)
+            self.assertNotIn(package, [c[2] for c in transport.calls])
+            self.assertEqual(transport.devices["pi"]["/" + ko], "ko v2")
+            self.assertNotIn("/" + dtbo, transport.devices["pi"])
+            script = transport.calls[-1][2]
+            self.assertIn(f"sudo rm -f -- /{other}", script)
+            self.assertIn("depmod", script)
+            self.assertNotIn("postinst", script)
+            self.assertNotIn("dpkg", script)
+            self.assertEqual(
+                deploy.parse_manifest(transport.devices["pi"][manifest_path]),
+                deploy.staged_manifest(staging),
+            )
+
+
+class TestSplitPackageDeploy(unittest.TestCase):
+    def test_find_packages(self):
+        import tempfile
+        from xdrvmake.deploy import find_packages
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("drv", "drv-6.1.0+rpt-rpi-v8", "drv-6.1.0+rpt-rpi-2712"):
+                open(os.path.join(tmp, f"{name}_1.0-1_arm64.deb"), "w").close()
+            package, kernel_packages = find_packages(tmp)
+            self.assertEqual(package, os.path.join(tmp, "drv_1.0-1_arm64.deb"))
+            self.assertEqual(
+                sorted(kernel_packages), ["6.1.0+rpt-rpi-2712", "6.1.0+rpt-rpi-v8"]
+            )
+            open(os.path.join(tmp, "other_1.0-1_arm64.deb"), "w").close()
+            with self.assertRaises(ValueError):
+                find_packages(tmp)
+
+    def test_find_packages_configured_version(self):
+        import tempfile
+        from xdrvmake.deploy import find_packages
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # left over by earlier builds of an auto version
+            for version in ("1.0.0-9-gabc", "1.0.0-12-gdef"):
+                for name in ("drv", "drv-6.1.0+rpt-rpi-v8"):
+                    open(
+                        os.path.join(tmp, f"{name}_{version}-1_arm64.deb"), "w"
+                    ).close()
+            # several versions and no Makefile to tell which one is current
+            with self.assertRaisesRegex(ValueError, "several versions of drv"):
+                find_packages(tmp)
+            with open(os.path.join(tmp, "Makefile"), "w") as f:
+                f.write("VERSION := 1.0.0-9-gabc\nTARGET ?= \n")
+            package, kernel_packages = find_packages(tmp)
+            self.assertEqual(package, os.path.join(tmp, "drv_1.0.0-9-gabc-1_arm64.deb"))
+            self.assertEqual(
+                kernel_packages,
+                {
+                    "6.1.0+rpt-rpi-v8": os.path.join(
+                        tmp, "drv-6.1.0+rpt-rpi-v8_1.0.0-9-gabc-1_arm64.deb"
+                    )
+                },
+            )
+
+    def test_deploy_running_kernel_package(self):
+        import tempfile
+        from xdrvmake import deploy, scheduler
+
+        with tempfile.TemporaryDirectory() as tmp:
+            staging = os.path.join(tmp, "staging")
+            for kver in ("6.1.0+rpt-rpi-v8", "6.1.0+rpt-rpi-2712"):
+                path = os.path.join(staging, "lib/modules", kver, "m.ko")
+                os.makedirs(os.path.dirname(path))
+                with open(path, "w") as f:
+                    f.write(kver)
+            package = os.path.join(tmp, "drv_1.0-1_arm64.deb")
+            kernel_packages = {
+                "6.1.0+rpt-rpi-v8": os.path.join(tmp, "drv-6.1.0+rpt-rpi-v8_1.0-1.deb")
+            }
+            transport = FakeTransport(delay=0)
+            for host, kver in (
+                ("pi4", "6.1.0+rpt-rpi-v8"),
+                ("pi5", "6.1.0+rpt-rpi-2712"),
+            ):
+                transport.devices[host] = {"/proc/sys/kernel/osrelease": kver + "\n"}
+            tasks = deploy.deploy_fleet(
+                ["pi4", "pi5"], package, transport, 2, staging, False, kernel_packages
+            )
+            status = {t.name: t.status for t in tasks}
+            self.assertEqual(status, {"pi4": scheduler.DONE, "pi5": scheduler.FAILED})
+            copies = [c[2] for c in transport.calls if c[0] == "copy" and c[1] == "pi4"]
+            self.assertEqual(copies[:2], [package, kernel_packages["6.1.0+rpt-rpi-v8"]])
+            manifest = transport.devices["pi4"]["/var/lib/xdrvmake/drv.sha256"]
+            self.assertEqual(
+                list(deploy.parse_manifest(manifest)),
+                ["lib/modules/6.1.0+rpt-rpi-v8/m.ko"],
+            )
+            self.assertIn("no package for kernel", tasks[1].error)
+
+
+class TestLocks(unittest.TestCase):
+    def hold(self, path, shared, acquired, release):
+        from xdrvmake import locks
+
+        with locks.file_lock(path, shared):
+            acquired.set()
+            release.wait(5)
+
+    def test_shared_and_exclusive(self):
+        import io
+        import tempfile
+        import threading
+        from contextlib import redirect_stderr
+        from xdrvmake import locks
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch.dict(os.environ, {"XDRVMAKE_LOCK_DIR": tmp}):
+                path = locks.buildroot_lock_path("buildroot")
+            self.assertEqual(os.path.dirname(path), tmp)
+            # two builds hold the buildroot at once
+            release = threading.Event()
+            holders = []
+            for _ in range(2):
+                acquired = threading.Event()
+                thread = threading.Thread(
+                    target=self.hold, args=(path, True, acquired, release)
+                )
+                thread.start()
+                self.assertTrue(acquired.wait(5))
+                holders.append(thread)
+            # the header install waits for both
+            acquired = threading.Event()
+            err = io.StringIO()
+            with redirect_stderr(err):
+                installer = threading.Thread(
+                    target=self.hold, args=(path, False, acquired, threading.Event())
+                )
+                installer.daemon = True
+                installer.start()
+                self.assertFalse(acquired.wait(0.2))
+                release.set()
+                for thread in holders:
+                    thread.join()
+                self.assertTrue(acquired.wait(5))
+            self.assertIn(f"waiting for exclusive lock on {path}", err.getvalue())
+
+    def test_project_lock(self):
+        import tempfile
+        from xdrvmake import locks
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with locks.project_lock(tmp):
+                self.assertTrue(
+                    os.path.exists(os.path.join(tmp, locks.project_lock_filename))
+                )
+            # released, so it can be taken again
+            with locks.project_lock(tmp):
+                pass
+
+    def test_existing_lock_opened_without_create(self):
+        import tempfile
+        from xdrvmake import locks
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "buildroot.lock")
+            open(path, "w").close()
+            opened = []
+            real_open = os.open
+
+            def fake_open(file, flags, *mode):
+                opened.append(flags)
+                # what fs.protected_regular does to another user's file
+                if flags & os.O_CREAT:
+                    raise PermissionError(13, "Permission denied", file)
+                return real_open(file, flags, *mode)
+
+            with patch("os.open", side_effect=fake_open):
+                with locks.file_lock(path, shared=True):
+                    pass
+            self.assertEqual(opened, [os.O_RDONLY])
+            # a missing lock file is still created
+            os.remove(path)
+            with locks.file_lock(path):
+                self.assertTrue(os.path.exists(path))
+
+
+class FakeWatcher:
+    """
+    Replays batches of changed paths, one per read, then stops the watch loop
+    like a Ctrl-C would.
+    """
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.timeouts = []
+
+    def read(self, timeout=None):
+        self.timeouts.append(timeout)
+        if not self.batches:
+            raise KeyboardInterrupt
+        return self.batches.pop(0)
+
+
+class TestWatch(unittest.TestCase):
+    graph = {
+        "kernels": {
+            "k1": [
+                "staging/lib/modules/k1/m.ko",
+                "staging/usr/lib/er-overlays/k1/p.dtbo",
+            ],
+            "k2": [
+                "staging/lib/modules/k2/m.ko",
+                "staging/usr/lib/er-overlays/k2/p.dtbo",
+            ],
+        },
+        "sources": {
+            "/p/p.dts": [
+                "staging/usr/lib/er-overlays/k1/p.dtbo",
+                "staging/usr/lib/er-overlays/k2/p.dtbo",
+            ],
+            "/p/src": ["staging/lib/modules/k1/m.ko", "staging/lib/modules/k2/m.ko"],
+        },
+        "final": "all",
+    }
+
+    def test_inotify_watcher(self):
+        import pathlib
+        import tempfile
+        from xdrvmake import watch
+
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+            dts = os.path.join(tmp, "p.dts")
+            os.mkdir(src)
+            pathlib.Path(dts).touch()
+            watcher = watch.InotifyWatcher([src, dts])
+            try:
+                for name in (os.path.join(tmp, "notes.txt"), f"{src}/.m.o.cmd"):
+                    pathlib.Path(name).write_text("x")
+                self.assertEqual(watcher.read(0.1), set())
+                pathlib.Path(f"{src}/m.c").write_text("x")
+                pathlib.Path(dts).write_text("x")
+                self.assertEqual(
+                    watch.wait_for_changes(watcher, 0.1), {f"{src}/m.c", dts}
+                )
+                # directories created later are watched too
+                os.mkdir(f"{src}/sub")
+                self.assertEqual(watcher.read(1), {f"{src}/sub"})
+                pathlib.Path(f"{src}/sub/x.h").write_text("x")
+                self.assertEqual(watcher.read(1), {f"{src}/sub/x.h"})
+            finally:
+                watcher.close()
+
+    def test_affected_targets(self):
+        from xdrvmake import watch
+
+        self.assertEqual(
+            watch.affected_targets(self.graph, {"/p/src/sub/x.h"}, ["k2"]),
+            ["staging/lib/modules/k2/m.ko"],
+        )
+        self.assertEqual(
+            watch.affected_targets(self.graph, {"/p/p.dts", "/p/srcx"}, ["k1", "k2"]),
+            [
+                "staging/usr/lib/er-overlays/k1/p.dtbo",
+                "staging/usr/lib/er-overlays/k2/p.dtbo",
+            ],
+        )
+        self.assertEqual(
+            watch.quickdeploy_targets(
+                self.graph,
+                ["ws/staging/lib/modules/k1/m.ko", "staging/lib/modules/k2/m.ko"],
+            ),
+            ["quickdeploy-k2"],
+        )
+
+    def test_watch_rebuilds_and_quickdeploys(self):
+        import subprocess
+        import tempfile
+        from xdrvmake import builder, watch
+
+        with tempfile.TemporaryDirectory() as tmp:
+            args = watch.get_args(
+                ["--build", tmp, "--target", "pi", "--kernel-ver", "k1", "-j", "1"]
+            )
+            # an edit saved in two bursts, a failing build, an unrelated file
+            watcher = FakeWatcher(
+                [
+                    {"/p/src/m.c"},
+                    {"/p/src/m.h"},
+                    set(),
+                    {"/p/p.dts"},
+                    set(),
+                    {"/x"},
+                    set(),
+                ]
+            )
+            commands = []
+
+            def exec_command(cmd, **kwargs):
+                commands.append(cmd)
+                if cmd[-1].endswith(".dtbo"):
+                    raise subprocess.CalledProcessError(2, cmd)
+                return ""
+
+            with patch.dict(os.environ, {"XDRVMAKE_LOCK_DIR": tmp}), patch.object(
+                builder, "exec_command", side_effect=exec_command
+            ), self.assertRaises(KeyboardInterrupt):
+                watch.watch(args, watcher, self.graph)
+
+        self.assertEqual(watcher.timeouts[:3], [None, 0.3, 0.3])
+        session = commands[0][-1]
+        make = ["make", "-C", tmp, f"SCHROOT_SESSION={session}"]
+        self.assertEqual(commands[0][:3], ["schroot", "-b", "-c"])
+        self.assertEqual(
+            commands[1:],
+            [
+                make
+                + [
+                    "TARGET=pi",
+                    "staging/lib/modules/k1/m.ko",
+                    "staging/usr/lib/er-overlays/k1/p.dtbo",
+                    "quickdeploy-k1",
+                ],
+                make + ["TARGET=pi", "staging/lib/modules/k1/m.ko", "quickdeploy-k1"],
+                make + ["TARGET=pi", "staging/usr/lib/er-overlays/k1/p.dtbo"],
+                ["schroot", "-e", "-c", session],
+            ],
+        )
+
+    def test_watch_command_requires_graph_sources(self):
+        import io
+        import json
+        import tempfile
+        from contextlib import redirect_stdout
+        from xdrvmake import builder, watch
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, builder.build_graph_filename), "w") as f:
+                json.dump({"kernels": {}, "final": "all"}, f)
+            with redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(watch.main(["--build", tmp]), 2)
+        self.assertIn("reconfigure", out.getvalue())
+
+
+class TestImportTime(unittest.TestCase):
+    # cumulative import time budget for xdrvmake.builder, in microseconds
+    budget_us = int(os.environ.get("XDRVMAKE_IMPORT_BUDGET_US", "250000"))
+    heavy_modules = ("jinja2", "yaml", "dotenv", "json")
+
+    def test_build_path_import_time(self):
+        import subprocess
+        import sys
+
+        repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import xdrvmake.builder"],
+            cwd=repo_root,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        imported = {}
+        for line in res.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                imported[name.strip()] = int(cumulative)
+        for mod in self.heavy_modules:
+            self.assertNotIn(mod, imported, f"{mod} imported on the build path")
+        self.assertIn("xdrvmake.builder", imported)
+        self.assertLess(imported["xdrvmake.builder"], self.budget_us)
+
+
 if __name__ == "__main__":
     # run the tests
     unittest.main()
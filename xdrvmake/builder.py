@@ -1,29 +1,85 @@
+# Only lightweight stdlib modules are imported at module level, so that the
+# `--build` path starts fast. jinja2, yaml, dotenv and json are
+# imported where they are used on the configure path.
+from __future__ import annotations
+
 import argparse
-from io import StringIO
-import json
+import collections
+import contextlib
+import functools
+import math
 import re
 import subprocess
-import yaml
-import jinja2
-from importlib.resources import files
+from types import CodeType
 import pathlib
 import os
-import dotenv
-import filelock
+import sys
+import threading
+import time
+from typing import IO, TYPE_CHECKING, Callable, Iterable, Iterator
+
+from xdrvmake import kocache, locks, trace
+
+if TYPE_CHECKING:
+    import jinja2
 
 
 manifest_filename = "kernel_version_file_list.json"
+fingerprint_filename = "kernel_version_file_list.fingerprint.json"
+apt_index_cache_filename = "kernel_headers_index_cache.json"
+build_graph_filename = "xdrvmake-graph.json"
+# must be reachable from inside the buildroot, schroot bind mounts /home
+default_ccache_dir = "~/.cache/xdrvmake/ccache"
+
+
+_semver_re = re.compile(r"([0-9]+)\.([0-9]+)\.([0-9]+)")
 
 
 def semver_key(ver_id):
     # Extract semver part before '+' or '-' or 'rpt' etc.
-    match = re.match(r"([0-9]+\.[0-9]+\.[0-9]+)", ver_id)
+    match = _semver_re.match(ver_id)
     if match:
-        parts = match.group(1).split(".")
-        return tuple(int(p) for p in parts)
+        return tuple(int(p) for p in match.groups())
     return (0, 0, 0)
 
 
+def kernel_version_pattern(
+    targets: Iterable[str], terminator: str = r"(?:/|\s)"
+) -> re.Pattern:
+    """
+    Builds a single pattern matching linux-headers lines for any of the targets.
+    Group 1 is the kernel version id, group 2 the target it ends with.
+    Longer targets come first so a more specific flavour wins over its suffix.
+    """
+    alternatives = "|".join(
+        re.escape(t) for t in sorted(set(targets), key=len, reverse=True)
+    )
+    return re.compile(r"linux-headers-([\w\.+-]+(" + alternatives + r"))" + terminator)
+
+
+def parse_kernel_version_ids(
+    lines: Iterable[str], targets: list[str], pattern: re.Pattern | None = None
+) -> dict[str, list[str]]:
+    """
+    Parses apt list output in a single pass, line by line, for all targets.
+    Example line:
+    linux-headers-6.12.47+rpt-rpi-v8/stable,now 1:6.12.47-1+rpt1 arm64 [installed]
+    Returns: {"rpi-v8": ["6.12.47+rpt-rpi-v8", ...], ...} sorted newest first
+    """
+    res: dict[str, list[str]] = {t: [] for t in targets}
+    if not res:
+        return res
+    if pattern is None:
+        pattern = kernel_version_pattern(targets)
+    for line in lines:
+        m = pattern.match(line)
+        if m:
+            res[m.group(2)].append(m.group(1))
+    for vers in res.values():
+        vers.sort(key=semver_key, reverse=True)
+    return res
+
+
 def extract_kernel_version_ids_single(apt_list_output: str, target: str) -> list[str]:
     """
     Extracts kernel version IDs from apt list output, filtering by a mandatory target ending.
@@ -31,23 +87,15 @@ def extract_kernel_version_ids_single(apt_list_output: str, target: str) -> list
     linux-headers-6.12.47+rpt-rpi-v8/stable,now 1:6.12.47-1+rpt1 arm64 [installed]
     Returns: ["6.12.25+rpt-rpi-v8", "6.12.34+rpt-rpi-v8", ...] for target="rpi-v8"
     """
-    version_ids = []
-    pattern = r"linux-headers-([\w\.+-]+" + re.escape(target) + r")(?:/|\s)"
-    for line in apt_list_output.strip().splitlines():
-        m = re.match(pattern, line)
-        if m:
-            version_ids.append(m.group(1))
-    return sorted(version_ids, key=semver_key, reverse=True)
+    return extract_kernel_version_ids(apt_list_output, [target])[target]
 
 
 def extract_kernel_version_ids(
-    apt_list_output: str, target: list[str]
+    apt_list_output: str | Iterable[str], target: list[str]
 ) -> dict[str, list[str]]:
-    res = {}
-    for t in target:
-        vers = extract_kernel_version_ids_single(apt_list_output, t)
-        res[t] = vers
-    return res
+    if isinstance(apt_list_output, str):
+        apt_list_output = apt_list_output.strip().splitlines()
+    return parse_kernel_version_ids(apt_list_output, target)
 
 
 def get_args():
@@ -56,11 +104,19 @@ def get_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument(
-        "projectdir",
+        "projectdirs",
+        metavar="projectdir",
         type=str,
-        help="path to project roo directory containing a'drivercfg.yaml' file",
-        default=os.getcwd(),
-        nargs="?",
+        help="path to project roo directory containing a'drivercfg.yaml' file, "
+        "several projects (or glob patterns) are configured as one workspace",
+        default=[],
+        nargs="*",
+    )
+    parser.add_argument(
+        "--workspace",
+        help="file listing the project directories (or glob patterns) of a "
+        "workspace one per line, relative to the file",
+        required=False,
     )
     parser.add_argument(
         "--build",
@@ -68,6 +124,14 @@ def get_args():
         required=False,
     )
 
+    parser.add_argument(
+        "--engine",
+        choices=("make", "python"),
+        default="make",
+        help="build engine for --build: 'make' runs make -j all, 'python' "
+        "schedules the per-kernel targets on an in-process worker pool",
+    )
+
     parser.add_argument(
         "--kernel-ver",
         help="kernel version to build the driver against, if not specified all versions will be built",
@@ -102,6 +166,64 @@ def get_args():
         default=3,
         help="number of last N kernel versions to install",
     )
+    parser.add_argument(
+        "--apt-update-ttl",
+        type=float,
+        default=3600,
+        help="skip apt update if the buildroot package lists are younger than "
+        "this many seconds (0 always updates)",
+    )
+    parser.add_argument(
+        "--ccache",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="compile the kernel modules through ccache (needs ccache in the "
+        "buildroot), overrides 'ccache' in drivercfg.yaml",
+    )
+    parser.add_argument(
+        "--ccache-dir",
+        help="persistent ccache directory, overrides 'ccache_dir' in "
+        f"drivercfg.yaml (default: {default_ccache_dir})",
+        required=False,
+    )
+    parser.add_argument(
+        "--ko-cache",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="restore built modules from a local cache keyed on the sources, "
+        "kernel, kbuild flags and toolchain, overrides 'ko_cache' in drivercfg.yaml",
+    )
+    parser.add_argument(
+        "--ko-cache-dir",
+        help="module cache directory, overrides 'ko_cache_dir' in "
+        f"drivercfg.yaml (default: {kocache.default_cache_dir})",
+        required=False,
+    )
+    parser.add_argument(
+        "--ko-cache-size",
+        help="module cache size limit, overrides 'ko_cache_size' in "
+        f"drivercfg.yaml (default: {kocache.default_max_size})",
+        required=False,
+    )
+    parser.add_argument(
+        "--split-packages",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="package every kernel's module and overlay separately, next to a "
+        "meta package, overrides 'split_packages' in drivercfg.yaml",
+    )
+    parser.add_argument(
+        "--template-cache",
+        help="directory for persisting compiled templates between runs",
+        required=False,
+        default=os.environ.get("XDRVMAKE_TEMPLATE_CACHE"),
+    )
+    parser.add_argument(
+        "--trace",
+        help="write a trace-event JSON timeline of the configure stages and "
+        "make targets to this file (open it in Perfetto)",
+        required=False,
+    )
     parser.add_argument(
         "-j",
         "--jobs",
@@ -113,6 +235,8 @@ def get_args():
     chrootname = pathlib.Path(parsed.chroot_root).name
     pvars = vars(parsed)
     pvars["chroot_name"] = chrootname
+    pvars["projectdir"] = parsed.projectdirs[0] if parsed.projectdirs else os.getcwd()
+    pvars["schroot_session"] = None
     return argparse.Namespace(**pvars)
 
 
@@ -125,16 +249,148 @@ def get_arch(targetfile: str) -> str:
     raise ValueError("Could not determine target architecture")
 
 
-def get_template(name: str) -> jinja2.Template:
-    template_path = files("xdrvmake").joinpath("templates", f"{name}.j2")
-    template_text = template_path.read_text(encoding="utf-8")
-    env = jinja2.Environment()
+def get_distro(targetfile: str) -> str:
+    with open(targetfile) as f:
+        for line in f.readlines():
+            if line.startswith("VERSION_CODENAME="):
+                return line.split("=")[1].strip().strip("'\"")
+    return ""
+
+
+def find_kernel_common_headers(
+    args: argparse.Namespace, kernel_versions: list[str]
+) -> dict[str, str]:
+    """
+    Maps each kernel version to its *-common-rpi header dir in the buildroot,
+    e.g. 6.12.34+rpt-rpi-v8 -> /var/chroot/buildroot/usr/src/linux-headers-6.12.34+rpt-common-rpi
+    """
+    import glob
+
+    chroot_root = os.path.normpath(args.chroot_root)
+    res = {}
+    for kver in kernel_versions:
+        kbasever = kver.split("-")[0]
+        matches = sorted(
+            glob.glob(
+                f"{glob.escape(chroot_root)}/usr/src/*{glob.escape(kbasever)}*-common-rpi"
+            )
+        )
+        if matches:
+            res[kver] = matches[0]
+    return res
+
+
+def read_dpkg_versions(args: argparse.Namespace) -> dict[str, str]:
+    """
+    Versions of the packages installed in the buildroot, read from the dpkg
+    status file without entering the chroot.
+    """
+    versions = {}
+    try:
+        with open(f"{args.chroot_root}/var/lib/dpkg/status") as f:
+            stanzas = f.read().split("\n\n")
+    except FileNotFoundError:
+        return {}
+    for stanza in stanzas:
+        fields = dict(
+            line.split(": ", 1) for line in stanza.splitlines() if ": " in line
+        )
+        if fields.get("Status", "").endswith(" installed") and "Package" in fields:
+            versions[fields["Package"]] = fields.get("Version", "")
+    return versions
+
+
+def compute_ko_cache_salts(args: argparse.Namespace, data: dict) -> dict[str, str]:
+    """
+    Per-kernel part of the module cache key known at configure time, the
+    generated Makefile adds the hash of the source tree at build time.
+    """
+    import json
+
+    packages = read_dpkg_versions(args)
+    toolchain = {
+        name: version
+        for name, version in packages.items()
+        if re.match(r"(gcc|binutils)(-|$)", name)
+    }
+    return {
+        kver: hash_text(
+            json.dumps(
+                {
+                    "kernel": kver,
+                    "headers": packages.get(f"linux-headers-{kver}", ""),
+                    "toolchain": toolchain,
+                    "kbuild_flags": data.get("kbuild_flags", ""),
+                    "modulename": data.get("modulename"),
+                    "architecture": data.get("architecture"),
+                },
+                sort_keys=True,
+            )
+        )
+        for kver in data.get("kernel_versions", [])
+    }
+
+
+def tuple_format(value, fmt):
+    return fmt.format(*value)
 
-    def tuple_format(value, fmt):
-        return fmt.format(*value)
 
+_template_env: jinja2.Environment | None = None
+
+
+def init_template_env(bytecode_cache_dir: str | None = None) -> jinja2.Environment:
+    """
+    (Re)creates the process-wide template environment. When bytecode_cache_dir
+    is given, compiled templates are persisted there and reused by later runs.
+    """
+    import jinja2
+
+    global _template_env
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+    env = jinja2.Environment(
+        loader=jinja2.PackageLoader("xdrvmake", "templates"),
+        bytecode_cache=bytecode_cache,
+    )
     env.filters["tuple_format"] = tuple_format
-    return env.from_string(template_text)
+    _template_env = env
+    _compile_template.cache_clear()
+    return env
+
+
+def get_template_env() -> jinja2.Environment:
+    if _template_env is None:
+        return init_template_env(os.environ.get("XDRVMAKE_TEMPLATE_CACHE"))
+    return _template_env
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_template(name: str) -> CodeType:
+    env = get_template_env()
+    assert env.loader is not None
+    source, filename, _ = env.loader.get_source(env, f"{name}.j2")
+    bcc = env.bytecode_cache
+    bucket = None
+    if bcc is not None:
+        bucket = bcc.get_bucket(env, name, filename, source)
+        if bucket.code is not None:
+            return bucket.code
+    code: CodeType = env.compile(source, name, filename)
+    if bcc is not None and bucket is not None:
+        bucket.code = code
+        bcc.set_bucket(bucket)
+    return code
+
+
+def get_template(name: str) -> jinja2.Template:
+    # every caller gets its own template object (and globals) backed by the
+    # shared compiled code, so set_globals() can't leak between renders
+    env = get_template_env()
+    return env.template_class.from_code(
+        env, _compile_template(name), env.make_globals(None)
+    )
 
 
 def set_globals(tmpl: jinja2.Template, data: dict) -> jinja2.Template:
@@ -152,6 +408,17 @@ def set_globals(tmpl: jinja2.Template, data: dict) -> jinja2.Template:
     tmpl.globals["min_supported"] = data["min_supported"]
     tmpl.globals["max_supported"] = data["max_supported"]
     tmpl.globals["kernel_versions"] = data.get("kernel_versions", [])
+    tmpl.globals["distro"] = data.get("distro", "")
+    tmpl.globals["kernel_common_headers"] = data.get("kernel_common_headers", {})
+    tmpl.globals["ccache"] = data.get("ccache", False)
+    tmpl.globals["ccache_dir"] = data.get("ccache_dir", default_ccache_dir)
+    tmpl.globals["ko_cache"] = data.get("ko_cache", False)
+    tmpl.globals["ko_cache_dir"] = data.get("ko_cache_dir", kocache.default_cache_dir)
+    tmpl.globals["ko_cache_size"] = data.get("ko_cache_size", kocache.default_max_size)
+    tmpl.globals["ko_cache_salts"] = data.get("ko_cache_salts", {})
+    tmpl.globals["python"] = sys.executable
+    tmpl.globals["chroot_root"] = data.get("chroot_root", "/var/chroot/buildroot")
+    tmpl.globals["split_packages"] = data.get("split_packages", False)
     return tmpl
 
 
@@ -160,17 +427,32 @@ def create_stating(args: argparse.Namespace, data: dict) -> None:
     files = ("control", "postinst", "postrm", "triggers")
     for file in files:
         render_debian_file(data, file)
-
-
-def render_debian_file(data, file):
-    tmpl = get_template(file)
+    if data.get("split_packages", False):
+        # the per-kernel packages get their artifacts hardlinked from staging
+        # by the Makefile, only their control files are rendered here
+        for kver in data.get("kernel_versions", []):
+            root = f"packages/{data['project']}-{kver}"
+            os.makedirs(f"{root}/DEBIAN", exist_ok=True)
+            for file in ("control", "postinst", "triggers"):
+                render_debian_file(data, file, root, f"kernel-{file}", kver=kver)
+
+
+def render_debian_file(
+    data: dict,
+    file: str,
+    root: str = "staging",
+    template: str | None = None,
+    **extra_globals: object,
+) -> None:
+    tmpl = get_template(template or file)
     set_globals(tmpl, data)
-    with open(f"staging/DEBIAN/{file}", "w") as f:
+    tmpl.globals.update(extra_globals)
+    with open(f"{root}/DEBIAN/{file}", "w") as f:
         f.write(tmpl.render())
         # add extra newline at end of file for debian compliance
         f.write("\n")
     if file != "control":
-        os.chmod(f"staging/DEBIAN/{file}", 0o755)
+        os.chmod(f"{root}/DEBIAN/{file}", 0o755)
 
 
 def get_kernel_vers(args: argparse.Namespace) -> list[str]:
@@ -184,77 +466,400 @@ def get_kernel_vers(args: argparse.Namespace) -> list[str]:
     ]
 
 
+def make_up_to_date(build_dir: str, targets: list[str]) -> bool:
+    cmd = ["make", "--no-print-directory", "-C", build_dir, "-q", *targets]
+    return subprocess.call(cmd) == 0
+
+
+def load_build_graph(build_dir: str) -> dict | None:
+    import json
+
+    try:
+        with open(f"{build_dir}/{build_graph_filename}") as f:
+            graph: dict = json.load(f)
+    except FileNotFoundError:
+        return None
+    return graph
+
+
+def build_up_to_date(build_dir: str) -> bool:
+    """
+    Whether "all" has nothing to do. It is phony (and so are the per-kernel
+    targets the packages depend on), so `make -q all` can't tell: the graph's
+    file targets must be up to date and every package newer than them and
+    the package metadata.
+    """
+    import glob
+
+    graph = load_build_graph(build_dir)
+    if graph is None or not graph.get("packages"):
+        return False
+    targets = [target for targets in graph["kernels"].values() for target in targets]
+    if targets and not make_up_to_date(build_dir, targets):
+        return False
+    try:
+        built = min(os.stat(f"{build_dir}/{p}").st_mtime for p in graph["packages"])
+    except FileNotFoundError:
+        return False
+    inputs = [f"{build_dir}/{target}" for target in targets]
+    for prefix in {os.path.dirname(p) for p in graph["packages"]}:
+        base = glob.escape(os.path.join(build_dir, prefix))
+        for pattern in (
+            "staging/DEBIAN/*",
+            "staging/usr/include/**",
+            "packages/*/DEBIAN/*",
+        ):
+            inputs.extend(
+                path
+                for path in glob.glob(os.path.join(base, pattern), recursive=True)
+                if os.path.isfile(path)
+            )
+    return all(os.stat(path).st_mtime <= built for path in inputs)
+
+
+def needs_chroot(args: argparse.Namespace) -> bool:
+    """
+    Whether a module will be built, the only recipes entering the buildroot.
+    Overlays and packages are made on the host.
+    """
+    graph = load_build_graph(args.build)
+    if graph is None:
+        return True
+    modules = [
+        target
+        for targets in graph["kernels"].values()
+        for target in targets
+        if target.endswith(".ko")
+    ]
+    return bool(modules) and not make_up_to_date(args.build, modules)
+
+
 def build_driver(args: argparse.Namespace) -> None:
-    exec_make(args, "all")
+    # builds of different projects run in parallel, but not while headers
+    # are installed into the buildroot
+    with locks.project_lock(args.build):
+        # a no-op build doesn't pay for the buildroot lock and schroot setup
+        if build_up_to_date(args.build):
+            print(f"{args.build} is up to date")
+            return
+        with locks.buildroot_lock(args.chroot_name, shared=True), (
+            schroot_session(args) if needs_chroot(args) else contextlib.nullcontext()
+        ):
+            if getattr(args, "engine", "make") == "python":
+                build_driver_scheduled(args)
+            else:
+                exec_make(args, "all")
+
+
+def build_driver_scheduled(args: argparse.Namespace) -> None:
+    """
+    Builds the per-kernel targets of the generated Makefile on our own worker
+    pool, one make invocation per file target so make's mtime checks still
+    decide what is stale, with per-task status and error reporting.
+    """
+    import json
+    from xdrvmake import scheduler
+
+    with open(f"{args.build}/{build_graph_filename}") as f:
+        graph = json.load(f)
+    tasks = [
+        scheduler.Task(target, kver)
+        for kver, targets in graph["kernels"].items()
+        for target in targets
+    ]
+    tasks.append(scheduler.Task(graph["final"], deps=[t.name for t in tasks]))
+    # split the --jobs budget between the concurrently running targets, each
+    # target's kbuild joins the jobserver of its own make
+    workers = max(1, min(args.jobs, len(tasks) - 1))
+    jobs_per_task = max(1, args.jobs // workers)
+
+    def run_task(task: scheduler.Task) -> str:
+        cmd = ["make", "-C", args.build]
+        if jobs_per_task > 1:
+            cmd.extend(["-j", str(jobs_per_task)])
+        session = getattr(args, "schroot_session", None)
+        if session is not None:
+            cmd.append(f"SCHROOT_SESSION={session}")
+        cmd.append(task.name)
+        if make_up_to_date(args.build, [task.name]):
+            return scheduler.UP_TO_DATE
+        prefix = f"[{task.label or task.name}] "
+        with trace.span(task.name, cat="build", kernel=task.label):
+            exec_command(
+                cmd,
+                on_line=lambda line: print(prefix + line),
+                on_stderr=lambda line: print(prefix + line, file=sys.stderr),
+                echo=False,
+            )
+        return scheduler.BUILT
+
+    ok = scheduler.run_graph(tasks, run_task, workers)
+    print(scheduler.format_summary(tasks))
+    if not ok:
+        failed = [t.name for t in tasks if t.status == scheduler.FAILED]
+        raise RuntimeError(f"build failed: {', '.join(failed)}")
+
+
+@contextlib.contextmanager
+def schroot_session(args: argparse.Namespace) -> Iterator[str]:
+    """
+    Opens a named schroot session on args.chroot_name that every chroot
+    command (including the per-kernel builds of the generated Makefile)
+    runs in, and ends it when the block exits, even on failure.
+    Nested uses share the already open session.
+    """
+    session = getattr(args, "schroot_session", None)
+    if session is not None:
+        yield session
+        return
+    session = f"xdrvmake-{os.getpid()}-{threading.get_ident()}"
+    with trace.span("schroot begin"):
+        exec_command(["schroot", "-b", "-c", args.chroot_name, "-n", session])
+    args.schroot_session = session
+    try:
+        yield session
+    finally:
+        args.schroot_session = None
+        with trace.span("schroot end"):
+            exec_command(["schroot", "-e", "-c", session])
+
+
+def schroot_command(
+    args: argparse.Namespace, cmd: list[str], directory: str = "/"
+) -> list[str]:
+    session = getattr(args, "schroot_session", None)
+    chroot = ["-r", "-c", session] if session else ["-c", args.chroot_name]
+    return ["schroot", *chroot, "-u", "root", "-d", directory, "--", *cmd]
+
+
+# number of output lines kept in memory per stream of a command
+max_captured_lines = 1000
+
+LineCallback = Callable[[str], None]
+
+
+def _echo_stderr(line: str) -> None:
+    print(line, file=sys.stderr)
+
 
+def _drain_stream(
+    stream: IO[bytes], tail: collections.deque, on_line: LineCallback | None
+) -> None:
+    with stream:
+        for raw in iter(stream.readline, b""):
+            line = raw.decode(errors="replace").rstrip("\n")
+            tail.append(line)
+            if on_line is not None:
+                on_line(line)
 
-def exec_command(cmd: list[str]) -> str:
+
+def iter_command(
+    cmd: list[str],
+    on_stderr: LineCallback | None = _echo_stderr,
+    timeout: float | None = None,
+    max_lines: int | None = None,
+    echo: bool = True,
+) -> Iterator[str]:
+    """
+    Runs cmd and yields its stdout line by line (stripped) as it is produced,
+    echoing it to our stdout unless echo is False.
+    stderr is drained concurrently by a helper thread so a chatty command can't
+    block on a full pipe; its last max_lines lines are kept for error reporting.
+    The process is killed after timeout seconds, raising TimeoutExpired.
+    Raises CalledProcessError once the output is exhausted if cmd failed.
+    """
     popen = subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    lines = []
-    if popen.stdout is None:
-        raise RuntimeError("Failed to capture stdout")
-    for line in iter(popen.stdout.readline, b""):
-        decoded = line.decode()
-        print(decoded, end="")
-        lines.append(decoded.strip())
-    retcode = popen.wait()
-    popen.stdout.close()
+    if popen.stdout is None or popen.stderr is None:
+        raise RuntimeError("Failed to capture output")
+    stderr_tail: collections.deque[str] = collections.deque(
+        maxlen=max_lines or max_captured_lines
+    )
+    stderr_reader = threading.Thread(
+        target=_drain_stream,
+        args=(popen.stderr, stderr_tail, on_stderr),
+        daemon=True,
+    )
+    stderr_reader.start()
+    timed_out = threading.Event()
+
+    def kill() -> None:
+        timed_out.set()
+        popen.kill()
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        for line in iter(popen.stdout.readline, b""):
+            decoded = line.decode(errors="replace")
+            if echo:
+                print(decoded, end="")
+            yield decoded.strip()
+    finally:
+        # also reached when the consumer stops early, closing the pipe
+        # makes the process exit on its next write instead of hanging
+        popen.stdout.close()
+        retcode = popen.wait()
+        if timer is not None:
+            timer.cancel()
+        stderr_reader.join()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(
+            cmd, timeout or 0, stderr="\n".join(stderr_tail)
+        )
     if retcode:
-        raise subprocess.CalledProcessError(retcode, cmd)
-    return "\n".join(lines)
+        raise subprocess.CalledProcessError(retcode, cmd, stderr="\n".join(stderr_tail))
+
+
+def exec_command(
+    cmd: list[str],
+    on_line: LineCallback | None = None,
+    on_stderr: LineCallback | None = _echo_stderr,
+    timeout: float | None = None,
+    max_lines: int | None = None,
+    echo: bool = True,
+) -> str:
+    """
+    Runs cmd to completion, returning at most the last max_lines lines of its
+    stdout. on_line is called for each stdout line as it arrives.
+    """
+    tail: collections.deque[str] = collections.deque(
+        maxlen=max_lines or max_captured_lines
+    )
+    for line in iter_command(cmd, on_stderr, timeout, max_lines, echo):
+        tail.append(line)
+        if on_line is not None:
+            on_line(line)
+    return "\n".join(tail)
 
 
 def exec_make(args: argparse.Namespace, target: str) -> str:
     cmd = ["make", "-C", args.build]
     if args.jobs > 1:
         cmd.extend(["-j", str(args.jobs)])
-    cmd.append(target)
-    return exec_command(cmd)
+    session = getattr(args, "schroot_session", None)
+    if session is not None:
+        cmd.append(f"SCHROOT_SESSION={session}")
+    labels = read_makefile_kernel_versions(args.build) if trace.enabled() else []
+    with trace.span(f"make {target}", cat="build"), trace.make_tracing(
+        labels
+    ) as trace_args:
+        cmd.extend(trace_args)
+        cmd.append(target)
+        return exec_command(cmd)
+
+
+def read_makefile_kernel_versions(build_dir: str) -> list[str]:
+    try:
+        with open(f"{build_dir}/Makefile") as f:
+            for line in f:
+                if line.startswith("KERNEL_VERSIONS ="):
+                    return line.split("=", 1)[1].split()
+    except FileNotFoundError:
+        pass
+    return []
 
 
 def apt_list_kernel_headers_in_buildroot(
     args: argparse.Namespace, globs: list[str]
-) -> str:
-    return exec_command(
-        [
-            "schroot",
-            "-c",
-            args.chroot_name,
-            "-u",
-            "root",
-            "-d",
-            "/",
-            "--",
-            "apt",
-            "list",
-            "-a",
-            *globs,
-        ]
-    )
+) -> Iterator[str]:
+    return iter_command(schroot_command(args, ["apt", "list", "-a", *globs]))
 
 
 def apt_install_kernel_headers_in_buildroot(
     args: argparse.Namespace, packages: list[str]
 ) -> str:
     return exec_command(
-        [
-            "schroot",
-            "-c",
-            args.chroot_name,
-            "-u",
-            "root",
-            "-d",
-            "/",
-            "--",
-            "apt_install",
-            "-y",
-            "--no-install-recommends",
-            *packages,
-        ]
+        schroot_command(
+            args, ["apt_install", "-y", "--no-install-recommends", *packages]
+        )
+    )
+
+
+def open_apt_index(path: str) -> IO[str]:
+    if path.endswith(".gz"):
+        import gzip
+
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.endswith(".xz"):
+        import lzma
+
+        return lzma.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def iter_apt_index_kernel_headers(path: str) -> Iterator[str]:
+    """
+    Streams an apt Packages index, yielding the linux-headers-* package names.
+    """
+    prefix = "Package: linux-headers-"
+    with open_apt_index(path) as f:
+        for line in f:
+            if line.startswith(prefix):
+                yield line[len("Package: ") :].strip()
+
+
+def find_apt_indexes(args: argparse.Namespace) -> list[str]:
+    lists_dir = pathlib.Path(f"{args.chroot_root}/var/lib/apt/lists")
+    if not lists_dir.is_dir():
+        return []
+    indexes = []
+    for entry in sorted(os.scandir(lists_dir), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        name = entry.name
+        if name.endswith("_Packages") or name.endswith(
+            ("_Packages.gz", "_Packages.xz")
+        ):
+            indexes.append(entry.path)
+        elif "_Packages." in name:
+            # compressed in a format we can't read (e.g. lz4), let apt do it
+            return []
+    return indexes
+
+
+def read_apt_index_kernel_headers(
+    args: argparse.Namespace, targets: list[str]
+) -> dict[str, list[str]] | None:
+    """
+    Answers which linux-headers-*-<target> versions are available by reading
+    the buildroot's apt indexes in process instead of running apt list.
+    Parsed indexes are cached keyed on their mtime and size.
+    Returns None if no readable indexes are found.
+    """
+    import json
+
+    indexes = find_apt_indexes(args)
+    if not indexes:
+        return None
+    try:
+        with open(apt_index_cache_filename) as f:
+            cache: dict = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    new_cache = {}
+    names: set[str] = set()
+    for path in indexes:
+        st = os.stat(path)
+        key = [st.st_mtime_ns, st.st_size]
+        entry = cache.get(path)
+        if entry is None or entry["key"] != key:
+            entry = {
+                "key": key,
+                "headers": sorted(set(iter_apt_index_kernel_headers(path))),
+            }
+        new_cache[path] = entry
+        names.update(entry["headers"])
+    if new_cache != cache:
+        with open(apt_index_cache_filename, "w") as f:
+            json.dump(new_cache, f)
+    return parse_kernel_version_ids(
+        sorted(names), targets, kernel_version_pattern(targets, "$")
     )
 
 
@@ -287,6 +892,8 @@ def load_manifest_data(data: dict, versions: dict) -> None:
 
 
 def load_manifest(data: dict) -> None:
+    import json
+
     with open(manifest_filename) as f:
         versions: dict = json.load(f)
         load_manifest_data(data, versions)
@@ -295,6 +902,8 @@ def load_manifest(data: dict) -> None:
 def compute_and_store_manifest(
     args: argparse.Namespace, versions: dict[str, list[str]]
 ) -> dict[str, list[str]]:
+    import json
+
     version_manifest = {}
     for plat, vers in versions.items():
         vers.sort(key=semver_key, reverse=True)
@@ -318,65 +927,407 @@ def get_installed_kernel_headers(
     return {t: [m for m in modules if m.endswith(t)] for t in targets}
 
 
+def hash_text(text: str) -> str:
+    import hashlib
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def dir_state(path: str | pathlib.Path) -> str:
+    """
+    Cheap fingerprint of a directory's direct entries (name, size, mtime).
+    """
+    try:
+        entries = sorted(os.scandir(path), key=lambda e: e.name)
+    except FileNotFoundError:
+        return ""
+    state = []
+    for entry in entries:
+        if entry.name in ("lock", "partial"):
+            continue
+        st = entry.stat()
+        state.append(f"{entry.name}:{st.st_size}:{st.st_mtime_ns}")
+    return hash_text("\n".join(state))
+
+
+def compute_fingerprint_inputs(
+    args: argparse.Namespace, drivercfg: str, target_text: str, plats: list[str]
+) -> dict:
+    return {
+        "target": hash_text(target_text),
+        "kernel_ver_count": args.kernel_ver_count,
+        "platforms": plats,
+        "apt_lists": dir_state(f"{args.chroot_root}/var/lib/apt/lists"),
+        "modules": dir_state(f"{args.chroot_root}/lib/modules"),
+        "drivercfg": drivercfg,
+    }
+
+
+def load_fingerprint() -> dict:
+    import json
+
+    try:
+        with open(fingerprint_filename) as f:
+            fingerprint: dict = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return fingerprint
+
+
+def store_fingerprint(fingerprint: dict) -> None:
+    import json
+
+    with open(fingerprint_filename, "w") as f:
+        json.dump(fingerprint, f, indent=4)
+
+
+def compute_missing_kernel_headers(
+    args: argparse.Namespace, packages: list[str], targets: list[str]
+) -> list[str]:
+    try:
+        installed = {
+            kver
+            for vers in get_installed_kernel_headers(args, targets).values()
+            for kver in vers
+        }
+    except FileNotFoundError:
+        installed = set()
+    return [p for p in packages if p.removeprefix("linux-headers-") not in installed]
+
+
+def apt_lists_age(args: argparse.Namespace, last_update: float | None) -> float:
+    """
+    Seconds since the buildroot's apt lists were last refreshed, either by us
+    (last_update) or by anything else (apt renames new lists into the dir).
+    Lists without any package index (apt clean, a fresh buildroot) are never
+    fresh, nothing could be found in them.
+    """
+    lists_dir = f"{args.chroot_root}/var/lib/apt/lists"
+    try:
+        refreshed = os.stat(lists_dir).st_mtime
+        names = os.listdir(lists_dir)
+    except FileNotFoundError:
+        return math.inf
+    if not any("_Packages" in name for name in names):
+        return math.inf
+    return time.time() - max(refreshed, last_update or 0.0)
+
+
 def install_kernel_headers(args: argparse.Namespace, data: dict) -> None:
-    if os.path.exists(manifest_filename):
+    """
+    Determines the kernel versions to build for and installs their headers in
+    the buildroot. The inputs of every stage are fingerprinted next to the
+    manifest, so warm runs reuse the manifest and only stages whose inputs
+    changed are redone:
+      - apt update: the lists are older than --apt-update-ttl (or hold no
+        package index), so new upstream headers are discovered even if
+        nothing else changed
+      - apt list: apt update ran, or the platform list or apt package lists
+        changed
+      - apt install: only the wanted headers missing from lib/modules
+      - manifest: any input changed
+    """
+    import json
+
+    drivercfg = hash_text(json.dumps(data, sort_keys=True, default=str))
+    with open(f"{args.target_dir}/target") as f:
+        target_text = f.read()
+    plats = get_target_kernel_package_names(target_text)
+    inputs = compute_fingerprint_inputs(args, drivercfg, target_text, plats)
+    stored = load_fingerprint()
+    stored_inputs = stored.get("inputs", {})
+    # only the installed headers are used without a kernel count
+    update_lists = (
+        args.kernel_ver_count != 0
+        and apt_lists_age(args, stored.get("apt_updated")) >= args.apt_update_ttl
+    )
+    if (
+        os.path.exists(manifest_filename)
+        and stored_inputs == inputs
+        and not update_lists
+    ):
         load_manifest(data)
         return
 
-    # use the installed kernel headers in the buildroot
-    plats = get_target_kernel_package_names(open(f"{args.target_dir}/target").read())
+    fingerprint: dict = {"apt_updated": stored.get("apt_updated")}
     if args.kernel_ver_count == 0:
-        load_manifest_data(
-            data,
-            compute_and_store_manifest(args, get_installed_kernel_headers(args, plats)),
-        )
-        return
-    apt_update_in_buildroot(args)
-    apt_list_pkgs = [f"linux-headers-*-{plat}" for plat in plats]
-    apt_list_output = apt_list_kernel_headers_in_buildroot(args, apt_list_pkgs)
-    versions = extract_kernel_version_ids(apt_list_output, plats)
-    to_install = compute_kernel_versions_to_install(args, versions)
-    apt_install_kernel_headers_in_buildroot(args, to_install)
+        # use the installed kernel headers in the buildroot
+        versions = get_installed_kernel_headers(args, plats)
+    else:
+        with contextlib.ExitStack() as stack:
+            # waits for running builds, apt changes the headers they use
+            with trace.span("wait for buildroot lock"):
+                stack.enter_context(locks.buildroot_lock(args.chroot_name))
+
+            def in_chroot() -> None:
+                # only pay for a schroot session if a chroot command runs
+                stack.enter_context(schroot_session(args))
+
+            versions = stored.get("available", {})
+            if (
+                update_lists
+                or stored_inputs.get("platforms") != plats
+                or stored_inputs.get("apt_lists") != inputs["apt_lists"]
+                or set(versions) != set(plats)
+            ):
+                if update_lists:
+                    in_chroot()
+                    with trace.span("apt update"):
+                        apt_update_in_buildroot(args)
+                    fingerprint["apt_updated"] = time.time()
+                with trace.span("read apt indexes"):
+                    indexed = read_apt_index_kernel_headers(args, plats)
+                if indexed is not None:
+                    versions = indexed
+                else:
+                    in_chroot()
+                    apt_list_pkgs = [f"linux-headers-*-{plat}" for plat in plats]
+                    with trace.span("apt list"):
+                        versions = parse_kernel_version_ids(
+                            apt_list_kernel_headers_in_buildroot(args, apt_list_pkgs),
+                            plats,
+                        )
+            to_install = compute_missing_kernel_headers(
+                args, compute_kernel_versions_to_install(args, versions), plats
+            )
+            if to_install:
+                in_chroot()
+                with trace.span("apt install", packages=to_install):
+                    apt_install_kernel_headers_in_buildroot(args, to_install)
+        fingerprint["available"] = {p: list(v) for p, v in versions.items()}
     load_manifest_data(data, compute_and_store_manifest(args, versions))
+    # apt update/install change the lists and modules, record the state after
+    fingerprint["inputs"] = compute_fingerprint_inputs(
+        args, drivercfg, target_text, plats
+    )
+    store_fingerprint(fingerprint)
 
 
 def apt_update_in_buildroot(args: argparse.Namespace) -> str:
-    return exec_command(
-        [
-            "schroot",
-            "-c",
-            args.chroot_name,
-            "-u",
-            "root",
-            "-d",
-            "/",
-            "--",
-            "apt_update",
-        ]
-    )
+    return exec_command(schroot_command(args, ["apt_update"]))
+
+
+# commands with their own argument parser, run as `xdrvmake <command> ...`
+subcommands = {
+    "cache": "xdrvmake.kocache",
+    "deploy": "xdrvmake.deploy",
+    "watch": "xdrvmake.watch",
+}
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        import importlib
+
+        command = importlib.import_module(subcommands[sys.argv[1]])
+        sys.exit(command.main(sys.argv[2:]))
     args = get_args()
+    if args.trace is not None:
+        trace.start()
+    try:
+        run(args)
+    finally:
+        if args.trace is not None:
+            trace.write(args.trace)
+
+
+def run(args: argparse.Namespace) -> None:
     if args.build is not None:
         build_driver(args)
         return
 
-    with open(f"{args.projectdir}/drivercfg.yaml") as f:
-        data: dict = yaml.safe_load(f)
+    with locks.project_lock("."):
+        projectdirs = expand_project_dirs(args)
+        if len(projectdirs) > 1 or getattr(args, "workspace", None):
+            configure_workspace(args, projectdirs)
+        else:
+            args.projectdir = projectdirs[0]
+            configure(args)
+
+
+def configure(args: argparse.Namespace) -> None:
 
-    install_kernel_headers(args, data)
+    import yaml
 
-    setup_derived_data(args, data)
+    with trace.span("load drivercfg"):
+        with open(f"{args.projectdir}/drivercfg.yaml") as f:
+            data: dict = yaml.safe_load(f)
 
-    create_makefile(data)
+    init_template_env(args.template_cache)
+
+    with trace.span("install kernel headers"):
+        install_kernel_headers(args, data)
+
+    configure_project(args, data)
+
+
+def configure_project(args: argparse.Namespace, data: dict) -> None:
+    """
+    Renders the Makefile and staging of one project into the current
+    directory, once its kernel versions are known.
+    """
+    with trace.span("setup derived data"):
+        setup_derived_data(args, data)
+        resolve_build_constants(args, data)
 
-    create_stating(args, data)
+    with trace.span("render Makefile"):
+        create_makefile(data)
+
+    with trace.span("render staging"):
+        create_stating(args, data)
+
+
+def expand_project_dirs(args: argparse.Namespace) -> list[str]:
+    """
+    The project directories given on the command line and listed in the
+    --workspace file, in order and without duplicates. Glob patterns are
+    expanded to the matching directories holding a drivercfg.yaml.
+    """
+    import glob
+
+    patterns = list(getattr(args, "projectdirs", None) or [args.projectdir])
+    workspace = getattr(args, "workspace", None)
+    if workspace:
+        base = os.path.dirname(os.path.abspath(workspace))
+        with open(workspace) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    patterns.append(os.path.join(base, line))
+    dirs: list[str] = []
+    for pattern in patterns:
+        if any(c in pattern for c in "*?["):
+            dirs.extend(
+                match
+                for match in sorted(glob.glob(pattern))
+                if os.path.exists(f"{match}/drivercfg.yaml")
+            )
+        else:
+            dirs.append(pattern)
+    # absolute, as every project is configured from its own output directory
+    return list(dict.fromkeys(os.path.abspath(d) for d in dirs))
+
+
+@contextlib.contextmanager
+def working_directory(path: str) -> Iterator[None]:
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def configure_workspace(args: argparse.Namespace, projectdirs: list[str]) -> None:
+    """
+    Configures several projects in one run: the kernel headers are discovered
+    and installed once into the shared manifest in the current directory,
+    every project is rendered into its own <project> subdirectory, and a
+    top-level Makefile builds them all.
+    """
+    import json
+    import yaml
+
+    configs = []
+    for projectdir in projectdirs:
+        with trace.span("load drivercfg", project=projectdir):
+            with open(f"{projectdir}/drivercfg.yaml") as f:
+                configs.append((projectdir, yaml.safe_load(f)))
+    names = [data["project"] for _, data in configs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"projects configured twice: {', '.join(duplicates)}")
+
+    init_template_env(args.template_cache)
+
+    # the headers to install only depend on the target, not on the projects
+    shared: dict = {}
+    with trace.span("install kernel headers"):
+        install_kernel_headers(args, shared)
+
+    graph: dict = {"kernels": {}, "sources": {}, "packages": [], "final": "all"}
+    for projectdir, data in configs:
+        for key in ("min_supported", "max_supported", "kernel_versions"):
+            data[key] = shared[key]
+        project_args = argparse.Namespace(
+            **{
+                **vars(args),
+                "projectdir": projectdir,
+                "target_dir": os.path.abspath(args.target_dir),
+                "chroot_root": os.path.abspath(args.chroot_root),
+            }
+        )
+        os.makedirs(data["project"], exist_ok=True)
+        with trace.span("configure project", project=data["project"]):
+            with locks.project_lock(data["project"]), working_directory(
+                data["project"]
+            ):
+                configure_project(project_args, data)
+        project_graph = compute_build_graph(data)
+        for key in ("kernels", "sources"):
+            for name, targets in project_graph[key].items():
+                graph[key].setdefault(name, []).extend(
+                    f"{data['project']}/{target}" for target in targets
+                )
+        graph["packages"].extend(
+            f"{data['project']}/{package}" for package in project_graph["packages"]
+        )
+
+    with trace.span("render workspace Makefile"):
+        tmpl = get_template("workspace-Makefile")
+        with open("Makefile", "w") as f:
+            f.write(
+                tmpl.render(projects=names, kernel_versions=shared["kernel_versions"])
+            )
+        with open(build_graph_filename, "w") as f:
+            json.dump(graph, f, indent=4)
 
 
 def create_makefile(data):
+    import json
+
     with open("Makefile", "w") as f:
         f.write(render_makefile(data))
+    with open(build_graph_filename, "w") as f:
+        json.dump(compute_build_graph(data), f, indent=4)
+
+
+def compute_build_graph(data: dict) -> dict:
+    """
+    The per-kernel file targets of the generated Makefile, for the python
+    build engine. Kernels are independent, "all" packages them once all
+    kernels are built. "sources" maps the source tree and the device tree
+    to the targets built from them, for watch mode, "packages" lists the
+    packages "all" makes.
+    """
+    project = data["project"]
+    projectroot = data.get("projectroot", ".")
+    sourcedir = f"{projectroot}/{data.get('sourcedir', 'src')}"
+    dts = f"{projectroot}/{project}.dts"
+    kernels = {}
+    sources: dict[str, list[str]] = {dts: []}
+    if not data.get("dts_only", False):
+        sources[sourcedir] = []
+    for kver in data.get("kernel_versions", []):
+        targets = []
+        if not data.get("dts_only", False):
+            ko = f"staging/lib/modules/{kver}/{data['modulename']}.ko"
+            targets.append(ko)
+            sources[sourcedir].append(ko)
+        dtbo = f"staging/usr/lib/er-overlays/{kver}/{project}.dtbo"
+        targets.append(dtbo)
+        sources[dts].append(dtbo)
+        kernels[kver] = targets
+    suffix = f"_{data['version']}-1_{data['architecture']}.deb"
+    packages = [f"{project}{suffix}"]
+    if data.get("split_packages", False):
+        packages.extend(f"{project}-{kver}{suffix}" for kver in kernels)
+    return {
+        "kernels": kernels,
+        "sources": sources,
+        "packages": packages,
+        "final": "all",
+    }
 
 
 def setup_derived_data(args, data):
@@ -389,9 +1340,50 @@ def setup_derived_data(args, data):
             .strip()
             .lstrip("v")
         )
+    # the command line overrides drivercfg
+    if getattr(args, "ccache", None) is not None:
+        data["ccache"] = args.ccache
+    data["ccache_dir"] = os.path.abspath(
+        os.path.expanduser(
+            getattr(args, "ccache_dir", None)
+            or data.get("ccache_dir")
+            or default_ccache_dir
+        )
+    )
+    if getattr(args, "split_packages", None) is not None:
+        data["split_packages"] = args.split_packages
+    if getattr(args, "ko_cache", None) is not None:
+        data["ko_cache"] = args.ko_cache
+    data["ko_cache_dir"] = os.path.abspath(
+        os.path.expanduser(
+            getattr(args, "ko_cache_dir", None)
+            or data.get("ko_cache_dir")
+            or kocache.default_cache_dir
+        )
+    )
+    data["ko_cache_size"] = str(
+        getattr(args, "ko_cache_size", None)
+        or data.get("ko_cache_size")
+        or kocache.default_max_size
+    )
+
+
+def resolve_build_constants(args: argparse.Namespace, data: dict) -> None:
+    # probed once here and emitted as literals, instead of being re-probed by
+    # $(shell ...) on every make expansion
+    data["distro"] = get_distro(f"{args.target_dir}/target")
+    data["chroot_root"] = os.path.normpath(args.chroot_root)
+    data["kernel_common_headers"] = find_kernel_common_headers(
+        args, data.get("kernel_versions", [])
+    )
+    if data.get("ko_cache", False):
+        data["ko_cache_salts"] = compute_ko_cache_salts(args, data)
 
 
 def get_target_kernel_package_names(target_file: str) -> list[str]:
+    from io import StringIO
+    import dotenv
+
     values = dotenv.dotenv_values(stream=StringIO(target_file))
     verlist = (values.get("RPI_KERNEL_VER_LIST") or "").split(",")
     plat_list = [
@@ -413,6 +1405,4 @@ def render_makefile(data: dict) -> str:
 
 
 if __name__ == "__main__":
-    lock = filelock.FileLock("xdrvmake.lock")
-    with lock:
-        main()
+    main()
@@ -0,0 +1,164 @@
+"""
+Make depfiles of the built modules, imported from kbuild's .cmd files.
+
+kbuild leaves a .<object>.cmd file next to every object it compiles, listing
+the object's source and every header it included (fixdep output). After a
+module is built, the generated Makefile turns those of the kernel's build
+directory into a depfile of the staged module, so editing any source of the
+tree (subdirectories included) or any header included from elsewhere
+rebuilds that kernel's module, and nothing else does.
+
+kbuild records the paths as seen in the buildroot, relative to the module or
+kernel build directory or absolute. They are mapped to the paths make sees:
+
+- files of the module build directory (a symlink farm of the source tree) to
+  the source file they link to; files kbuild generated there are dropped.
+  Links into the --source-copy of the tree are mapped back to the original
+- other relative paths to the first --search directory (the kernel headers
+  trees) holding them
+- absolute paths to the same path below --root (the buildroot)
+
+Paths that don't exist on the host are dropped. Like `gcc -MP`, every
+dependency also gets an empty rule, so deleting a header rebuilds the module
+instead of failing the build.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from typing import Iterator
+
+
+def iter_cmd_deps(path: str) -> Iterator[str]:
+    """
+    The source_* and deps_* entries of a kbuild .cmd file, without the
+    $(wildcard include/config/...) ones tracking kconfig options.
+    """
+    in_deps = False
+    with open(path, errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("source_") and ":=" in line:
+                yield line.split(":=", 1)[1].strip()
+                continue
+            if line.startswith("deps_") and ":=" in line:
+                in_deps = True
+                line = line.split(":=", 1)[1].strip()
+            if in_deps:
+                in_deps = line.endswith("\\")
+                entry = line.rstrip("\\").strip()
+                if entry and not entry.startswith("$("):
+                    yield entry
+
+
+def host_path(
+    dep: str,
+    build_dir: str,
+    root: str,
+    search: list[str],
+    source_copy: tuple[str, str] | None = None,
+) -> str | None:
+    if os.path.isabs(dep) and not dep.startswith(build_dir + "/"):
+        path = os.path.normpath(f"{root}/{dep}")
+        return path if os.path.lexists(path) else None
+    local = os.path.normpath(os.path.join(build_dir, dep))
+    if os.path.exists(local):
+        source = os.path.realpath(local)
+        if source.startswith(build_dir + "/"):
+            return None
+        if source_copy is not None:
+            copy, original = source_copy
+            if source.startswith(copy + "/"):
+                return os.path.join(original, os.path.relpath(source, copy))
+        return source
+    for directory in search:
+        path = os.path.normpath(os.path.join(directory, dep))
+        if os.path.lexists(path):
+            return path
+    return None
+
+
+def module_deps(
+    build_dir: str,
+    root: str,
+    search: list[str],
+    source_copy: tuple[str, str] | None = None,
+) -> list[str]:
+    """
+    The host paths of every source and header the objects in build_dir were
+    compiled from.
+    """
+    build_dir = os.path.realpath(build_dir)
+    if source_copy is not None:
+        source_copy = (os.path.realpath(source_copy[0]), source_copy[1])
+    deps = set()
+    for directory, _, files in os.walk(build_dir):
+        for name in files:
+            if name.startswith(".") and name.endswith(".o.cmd"):
+                for dep in iter_cmd_deps(os.path.join(directory, name)):
+                    path = host_path(dep, build_dir, root, search, source_copy)
+                    if path is not None:
+                        deps.add(path)
+    return sorted(deps)
+
+
+def _escape(path: str) -> str:
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def format_depfile(target: str, deps: list[str]) -> str:
+    lines = [f"{_escape(target)}:" + "".join(f" \\\n {_escape(d)}" for d in deps)]
+    lines.extend(f"\n{_escape(dep)}:" for dep in deps)
+    return "\n".join(lines) + "\n"
+
+
+def get_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m xdrvmake.depfile",
+        description="Write a make depfile of a module from kbuild's .cmd files",
+    )
+    parser.add_argument("--root", default="/", help="root of the buildroot")
+    parser.add_argument(
+        "--search",
+        action="append",
+        default=[],
+        help="directory relative paths outside the build dir are found in "
+        "(can be repeated)",
+    )
+    parser.add_argument(
+        "--source-copy",
+        nargs=2,
+        metavar=("COPY", "ORIGINAL"),
+        help="copy of the source tree the build dir links to, and the tree "
+        "it was copied from",
+    )
+    parser.add_argument("-o", "--output", required=True, help="depfile to write")
+    parser.add_argument("build_dir", help="kbuild output directory of the module")
+    parser.add_argument("target", help="make target depending on the sources")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = get_args(argv)
+    source_copy = tuple(args.source_copy) if args.source_copy else None
+    deps = module_deps(args.build_dir, args.root, args.search, source_copy)
+    if not deps:
+        # the module is built, it just keeps the Makefile's own prerequisites
+        print(
+            f"warning: no kbuild dependencies found in {args.build_dir}",
+            file=sys.stderr,
+        )
+        return 0
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    # an interrupted write must not leave a truncated depfile for make
+    tmp = f"{args.output}.tmp"
+    with open(tmp, "w") as f:
+        f.write(format_depfile(args.target, deps))
+    os.replace(tmp, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,368 @@
+"""
+Fleet deploy: installs the built package on many targets concurrently.
+
+    xdrvmake deploy [--build DIR] [-i INVENTORY] [-j JOBS] [--delta] [HOST ...]
+
+Every host is a task of the build scheduler without dependencies, so at most
+--jobs hosts are deployed at a time, one failing host doesn't stop the others
+and the run ends with a per-host summary with timings. The ssh options match
+the generated Makefile's, so deploys reuse the same multiplexed connections.
+
+Every deploy leaves a sha256sum style manifest of the staged modules and
+overlays on the device. With --delta only the artifacts whose checksum differs
+from the device's manifest are transferred and unpacked, instead of the whole
+package; hosts without a manifest get the full package. With split packages
+(--split-packages at configure time) every host gets the meta package and the
+package of its running kernel.
+"""
+
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import io
+import os
+import sys
+import tarfile
+import tempfile
+from typing import Protocol
+
+from xdrvmake import scheduler
+from xdrvmake.builder import exec_command
+
+ssh_options = [
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=/tmp/xdrvmake-ssh-%C",
+    "-o",
+    "ControlPersist=10m",
+    # a host asking for a password would block its worker forever
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ConnectTimeout=10",
+]
+
+# manifest of the deployed artifacts on the device, relative to /
+manifest_dir = "var/lib/xdrvmake"
+# staging subdirectories holding the per-kernel artifacts
+artifact_dirs = ("lib/modules", "usr/lib/er-overlays")
+
+
+class Transport(Protocol):
+    def copy(self, host: str, path: str, remote_dir: str) -> None: ...
+
+    def run(self, host: str, script: str) -> None: ...
+
+    def read(self, host: str, path: str) -> str: ...
+
+
+class SshTransport:
+    def __init__(self, timeout: float | None = None) -> None:
+        self.timeout = timeout
+
+    def _exec(self, host: str, cmd: list[str], quiet: bool = False) -> str:
+        prefix = f"[{host}] "
+        return exec_command(
+            cmd,
+            on_line=None if quiet else lambda line: print(prefix + line),
+            on_stderr=lambda line: print(prefix + line, file=sys.stderr),
+            timeout=self.timeout,
+            max_lines=1 << 20,
+            echo=False,
+        )
+
+    def copy(self, host: str, path: str, remote_dir: str) -> None:
+        ssh = " ".join(["ssh", *ssh_options])
+        self._exec(host, ["rsync", "-e", ssh, "-az", path, f"{host}:{remote_dir}/"])
+
+    def run(self, host: str, script: str) -> None:
+        self._exec(host, ["ssh", *ssh_options, host, "--", script])
+
+    def read(self, host: str, path: str) -> str:
+        script = f"cat {path} 2>/dev/null || true"
+        return self._exec(host, ["ssh", *ssh_options, host, "--", script], True)
+
+
+def read_inventory(path: str) -> list[str]:
+    """
+    One host per line, blank lines and '#' comments are ignored.
+    """
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            host = line.split("#", 1)[0].strip()
+            if host:
+                hosts.append(host)
+    return hosts
+
+
+def package_project(package: str) -> str:
+    return os.path.basename(package).split("_", 1)[0]
+
+
+def read_makefile_version(build_dir: str) -> str | None:
+    try:
+        with open(f"{build_dir}/Makefile") as f:
+            for line in f:
+                if line.startswith("VERSION :="):
+                    return line.split(":=", 1)[1].strip()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def find_packages(build_dir: str) -> tuple[str, dict[str, str]]:
+    """
+    Returns the package of the configured version built in build_dir and, for
+    split packages, the per-kernel packages by kernel version
+    (<project>-<kver>_...deb). Packages of older versions are left around by
+    the Makefile, so they are ignored, or refused without a Makefile.
+    """
+    version = read_makefile_version(build_dir)
+    pattern = "*" if version is None else glob.escape(version)
+    packages = sorted(glob.glob(f"{glob.escape(build_dir)}/*_{pattern}-1_*.deb"))
+    if not packages:
+        raise FileNotFoundError(
+            f"no package in {build_dir}, run xdrvmake --build {build_dir} first"
+        )
+    names: dict[str, str] = {}
+    for package in packages:
+        project = package_project(package)
+        if project in names:
+            raise ValueError(
+                f"several versions of {project} in {build_dir}: "
+                f"{os.path.basename(names[project])}, {os.path.basename(package)}"
+            )
+        names[project] = package
+    for project, package in names.items():
+        others = {n: p for n, p in names.items() if n != project}
+        if all(n.startswith(f"{project}-") for n in others):
+            return package, {n[len(project) + 1 :]: p for n, p in others.items()}
+    raise ValueError(f"several packages in {build_dir}: {', '.join(packages)}")
+
+
+def install_script(package: str, kernel_package: str | None = None) -> str:
+    # same steps as the Makefile's deploy target
+    names = [os.path.basename(package)]
+    if kernel_package is not None:
+        names.append(os.path.basename(kernel_package))
+    project = package_project(package)
+    return (
+        f"sudo dpkg --force-all -i {' '.join(f'/tmp/{n}' for n in names)} && "
+        f"sudo sed -ri '/^\\s*dtoverlay={project}/d' /boot/config.txt && "
+        f"echo 'dtoverlay={project}' | sudo tee -a /boot/config.txt"
+    )
+
+
+def file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def staged_manifest(staging: str) -> dict[str, str]:
+    """
+    Maps the path (relative to /) of every staged module and overlay to its
+    sha256.
+    """
+    manifest = {}
+    for artifact_dir in artifact_dirs:
+        for root, _, files in os.walk(os.path.join(staging, artifact_dir)):
+            for name in files:
+                full = os.path.join(root, name)
+                manifest[os.path.relpath(full, staging)] = file_sha256(full)
+    return dict(sorted(manifest.items()))
+
+
+def format_manifest(manifest: dict[str, str]) -> str:
+    # sha256sum format, `cd / && sha256sum -c` verifies the device
+    return "".join(f"{digest}  {path}\n" for path, digest in manifest.items())
+
+
+def parse_manifest(text: str) -> dict[str, str]:
+    manifest = {}
+    for line in text.splitlines():
+        digest, sep, path = line.partition("  ")
+        if sep and len(digest) == 64:
+            manifest[path] = digest
+    return manifest
+
+
+def compute_delta(
+    local: dict[str, str], remote: dict[str, str]
+) -> tuple[list[str], list[str]]:
+    """
+    Returns the paths to transfer (new or changed) and the ones to remove from
+    the device (no longer staged).
+    """
+    changed = [path for path, digest in local.items() if remote.get(path) != digest]
+    removed = [path for path in remote if path not in local]
+    return changed, removed
+
+
+def write_bundle(
+    path: str, staging: str, files: list[str], manifest_path: str, manifest: str
+) -> None:
+    """
+    Tar of the given staged files and the new manifest, to be unpacked in /
+    on the device.
+    """
+
+    def owned_by_root(info: tarfile.TarInfo) -> tarfile.TarInfo:
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        return info
+
+    with tarfile.open(path, "w") as tar:
+        for file in files:
+            tar.add(os.path.join(staging, file), file, filter=owned_by_root)
+        data = manifest.encode()
+        info = owned_by_root(tarfile.TarInfo(manifest_path))
+        info.size = len(data)
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+
+
+def delta_script(
+    project: str, bundle: str, changed: list[str], removed: list[str]
+) -> str:
+    steps = [f"sudo tar -C / -xf /tmp/{bundle}"]
+    if removed:
+        steps.append("sudo rm -f -- " + " ".join(f"/{path}" for path in removed))
+    if any(path.endswith(".ko") for path in changed + removed):
+        steps.append("{ sudo depmod -a || true; }")
+    if any(path.endswith(".dtbo") for path in changed + removed):
+        # reselects the overlay for the next boot kernel, as dpkg would
+        steps.append(f"sudo sh /var/lib/dpkg/info/{project}.postinst configure")
+    steps.append(f"rm -f /tmp/{bundle}")
+    return " && ".join(steps)
+
+
+def deploy_fleet(
+    hosts: list[str],
+    package: str,
+    transport: Transport,
+    jobs: int,
+    staging: str | None = None,
+    delta: bool = False,
+    kernel_packages: dict[str, str] | None = None,
+) -> list[scheduler.Task]:
+    """
+    Deploys package to every host, at most jobs at a time, and returns the
+    finished per-host tasks. With staging, a manifest of its artifacts is left
+    on every host; with delta, hosts that have one only get what changed.
+    With split kernel_packages, every host also gets the one of its kernel.
+    """
+    project = package_project(package)
+    manifest_path = f"{manifest_dir}/{project}.sha256"
+    bundle = f"{project}-artifacts.tar"
+    staged = staged_manifest(staging) if staging is not None else {}
+
+    def deploy_host(task: scheduler.Task) -> str:
+        host = task.name
+        kernel_package = None
+        local = staged
+        if kernel_packages:
+            kver = transport.read(host, "/proc/sys/kernel/osrelease").strip()
+            if kver not in kernel_packages:
+                raise ValueError(f"no package for kernel {kver!r} of {host}")
+            kernel_package = kernel_packages[kver]
+            local = {p: d for p, d in staged.items() if f"/{kver}/" in p}
+        manifest = format_manifest(local)
+        remote = None
+        if delta and staging is not None:
+            remote = parse_manifest(transport.read(host, f"/{manifest_path}"))
+        with tempfile.TemporaryDirectory(prefix="xdrvmake-deploy-") as tmp:
+            if remote:
+                changed, removed = compute_delta(local, remote)
+                if not changed and not removed:
+                    print(f"[{host}] up to date")
+                    return scheduler.UP_TO_DATE
+                print(f"[{host}] {len(changed)} changed, {len(removed)} removed")
+                script = delta_script(project, bundle, changed, removed)
+            else:
+                changed = []
+                transport.copy(host, package, "/tmp")
+                if kernel_package is not None:
+                    transport.copy(host, kernel_package, "/tmp")
+                script = install_script(package, kernel_package)
+                if staging is not None:
+                    script += (
+                        f" && sudo tar -C / -xf /tmp/{bundle} && rm -f /tmp/{bundle}"
+                    )
+            if staging is not None:
+                write_bundle(
+                    os.path.join(tmp, bundle), staging, changed, manifest_path, manifest
+                )
+                transport.copy(host, os.path.join(tmp, bundle), "/tmp")
+            transport.run(host, script)
+        return scheduler.DONE
+
+    tasks = [scheduler.Task(host) for host in dict.fromkeys(hosts)]
+    scheduler.run_graph(tasks, deploy_host, jobs)
+    return tasks
+
+
+def get_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="xdrvmake deploy",
+        description="Install the built package on many targets in parallel",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("hosts", nargs="*", help="[user@]host to deploy to")
+    parser.add_argument(
+        "-i",
+        "--inventory",
+        action="append",
+        default=[],
+        help="file listing one host per line (can be repeated)",
+    )
+    parser.add_argument(
+        "--build", default=os.getcwd(), help="build directory holding the package"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8, help="number of hosts deployed at a time"
+    )
+    parser.add_argument(
+        "--timeout", type=float, help="seconds allowed per transfer or install"
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="transfer only the modules and overlays whose checksum differs "
+        "from the manifest left on the device by the previous deploy",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = get_args(argv)
+    hosts = list(args.hosts)
+    for inventory in args.inventory:
+        hosts.extend(read_inventory(inventory))
+    if not hosts:
+        print("no hosts given", file=sys.stderr)
+        return 2
+    package, kernel_packages = find_packages(args.build)
+    staging = os.path.join(args.build, "staging")
+    tasks = deploy_fleet(
+        hosts,
+        package,
+        SshTransport(args.timeout),
+        args.jobs,
+        staging if os.path.isdir(staging) else None,
+        args.delta,
+        kernel_packages,
+    )
+    print(scheduler.format_summary(tasks))
+    failed = [t for t in tasks if t.status not in scheduler.succeeded]
+    if failed:
+        print(f"{len(failed)} of {len(tasks)} hosts failed", file=sys.stderr)
+        return 1
+    return 0
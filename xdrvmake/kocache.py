@@ -0,0 +1,222 @@
+"""
+Local content-addressed cache of built kernel modules.
+
+An entry is keyed on the hash of the module's source tree and a configure-time
+salt (kernel version, kbuild flags, header package and toolchain versions), so
+a hit can be restored into staging without entering the buildroot. Entries
+are evicted least recently used first (fetching an entry refreshes its mtime)
+once the cache grows over its size limit.
+
+The generated Makefile calls the fetch/store commands, users the stats/prune
+ones (as `xdrvmake cache ...`).
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from typing import Iterator
+
+default_cache_dir = "~/.cache/xdrvmake/ko"
+default_max_size = "2G"
+
+_size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text: str) -> int:
+    """
+    Parses a byte count with an optional K/M/G/T (binary) suffix.
+    """
+    text = text.strip().upper().removesuffix("B").removesuffix("I")
+    unit = text[-1:] if text[-1:] in _size_units else ""
+    return int(float(text[: len(text) - len(unit)]) * _size_units[unit])
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def tree_hash(path: str) -> str:
+    """
+    Hash of the relative paths and contents of every file under path, hidden
+    files and directories (.git, kbuild .cmd files) excluded.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            full = os.path.join(root, name)
+            digest.update(os.path.relpath(full, path).encode() + b"\0")
+            with open(full, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def cache_key(source: str, salt: str) -> str:
+    import hashlib
+
+    return hashlib.sha256(f"{salt}:{tree_hash(source)}".encode()).hexdigest()
+
+
+def entry_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key[:2], f"{key}.ko")
+
+
+def _copy_atomic(src: str, dest: str) -> None:
+    # written under a temporary name first, so neither a concurrent reader nor
+    # an interrupted copy ever sees a partial file
+    import shutil
+
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def fetch(cache_dir: str, key: str, dest: str) -> bool:
+    """
+    Copies the entry to dest, returns False on a miss. The entry is copied,
+    not linked, so later writes to the staged file can't corrupt the cache.
+    """
+    path = entry_path(cache_dir, key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    _copy_atomic(path, dest)
+    return True
+
+
+def store(cache_dir: str, key: str, src: str, max_size: int) -> None:
+    path = entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _copy_atomic(src, path)
+    prune(cache_dir, max_size)
+
+
+def iter_entries(cache_dir: str) -> Iterator[os.DirEntry]:
+    try:
+        buckets = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return
+    for bucket in buckets:
+        if bucket.is_dir():
+            yield from (e for e in os.scandir(bucket.path) if e.name.endswith(".ko"))
+
+
+def stats(cache_dir: str) -> dict:
+    mtimes = []
+    size = 0
+    for entry in iter_entries(cache_dir):
+        st = entry.stat()
+        mtimes.append(st.st_mtime)
+        size += st.st_size
+    return {
+        "entries": len(mtimes),
+        "size": size,
+        "oldest": min(mtimes, default=None),
+        "newest": max(mtimes, default=None),
+    }
+
+
+def prune(cache_dir: str, max_size: int) -> list[str]:
+    """
+    Removes the least recently used entries until the cache fits in max_size,
+    returns the removed paths.
+    """
+    entries = []
+    for entry in iter_entries(cache_dir):
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            # pruned by a parallel build
+            continue
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def get_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="xdrvmake cache",
+        description="Manage the local cache of built kernel modules",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--dir",
+        default=os.environ.get("XDRVMAKE_KO_CACHE_DIR", default_cache_dir),
+        help="cache directory",
+    )
+    parser.add_argument(
+        "--max-size",
+        default=os.environ.get("XDRVMAKE_KO_CACHE_SIZE", default_max_size),
+        help="size limit, least recently used modules are evicted above it",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show the number and size of cached modules")
+    commands.add_parser("prune", help="evict modules until the cache fits --max-size")
+    for name, help in (
+        ("fetch", "copy the cached module to PATH, exits 1 on a miss"),
+        ("store", "add the module at PATH to the cache"),
+    ):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("--source", required=True, help="module source tree")
+        command.add_argument("--salt", required=True, help="configure-time key salt")
+        command.add_argument("path")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = get_args(argv)
+    cache_dir = os.path.expanduser(args.dir)
+    max_size = parse_size(args.max_size)
+    if args.command == "stats":
+        st = stats(cache_dir)
+        print(f"directory: {cache_dir}")
+        print(f"entries:   {st['entries']}")
+        print(f"size:      {format_size(st['size'])} of {format_size(max_size)}")
+        if st["entries"]:
+            now = time.time()
+            print(f"oldest:    {(now - st['oldest']) / 3600:.1f}h ago")
+            print(f"newest:    {(now - st['newest']) / 3600:.1f}h ago")
+    elif args.command == "prune":
+        removed = prune(cache_dir, max_size)
+        print(f"removed {len(removed)} modules")
+    elif args.command == "fetch":
+        if not fetch(cache_dir, cache_key(args.source, args.salt), args.path):
+            return 1
+        print(f"restored {args.path} from the module cache")
+    elif args.command == "store":
+        try:
+            store(cache_dir, cache_key(args.source, args.salt), args.path, max_size)
+        except OSError as e:
+            # the module is built, a cache that can't be written doesn't fail it
+            print(f"warning: could not cache {args.path}: {e}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
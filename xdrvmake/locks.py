@@ -0,0 +1,67 @@
+"""
+Advisory flock(2) locks scoped to the resources xdrvmake shares between
+processes:
+
+- the buildroot: exclusive while kernel headers are installed into it, shared
+  while modules are built against it, so any number of builds run in
+  parallel but never while apt changes the headers
+- a project's output directory (Makefile, staging, manifest): exclusive while
+  it is configured or built
+
+Locks are always taken in that order (project, then buildroot) so they can't
+deadlock. The kernel releases them when the holding process dies.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import os
+import sys
+import tempfile
+from typing import Iterator
+
+project_lock_filename = "xdrvmake.lock"
+
+
+def buildroot_lock_path(chroot_name: str) -> str:
+    # shared by every user building in the buildroot, so it can't live in a
+    # per-user directory
+    lock_dir = os.environ.get("XDRVMAKE_LOCK_DIR", tempfile.gettempdir())
+    return os.path.join(lock_dir, f"xdrvmake-buildroot-{chroot_name}.lock")
+
+
+@contextlib.contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """
+    Holds a shared or exclusive lock on path (created if needed) for the
+    duration of the block, telling the user when it has to wait.
+    """
+    # locking needs no write access, so other users can lock a file we created.
+    # O_CREAT only if it's missing: with fs.protected_regular, an O_CREAT open
+    # of another user's file in sticky /tmp fails even though it exists
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+    try:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            kind = "shared" if shared else "exclusive"
+            print(f"waiting for {kind} lock on {path}", file=sys.stderr)
+            fcntl.flock(fd, mode)
+        yield
+    finally:
+        os.close(fd)
+
+
+def buildroot_lock(
+    chroot_name: str, shared: bool = False
+) -> contextlib.AbstractContextManager[None]:
+    return file_lock(buildroot_lock_path(chroot_name), shared)
+
+
+def project_lock(directory: str) -> contextlib.AbstractContextManager[None]:
+    return file_lock(os.path.join(directory, project_lock_filename))
@@ -0,0 +1,110 @@
+"""
+In-process DAG scheduler running build tasks on a bounded worker pool.
+
+Every task runs one external command (a make target), so a thread pool gives
+a bounded pool of concurrently running build processes.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Callable, Iterable
+
+# task states
+PENDING = "pending"
+RUNNING = "running"
+BUILT = "built"
+UP_TO_DATE = "up-to-date"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Task:
+    def __init__(self, name: str, label: str = "", deps: Iterable[str] = ()) -> None:
+        self.name = name
+        self.label = label
+        self.deps = list(deps)
+        self.status = PENDING
+        self.start = 0.0
+        self.end = 0.0
+        self.error = ""
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return f"Task({self.name!r}, {self.status})"
+
+
+succeeded = (BUILT, UP_TO_DATE, DONE)
+
+# runs a task, returns one of the succeeded states, raises on failure
+TaskRunner = Callable[[Task], str]
+
+
+def run_graph(tasks: list[Task], run_task: TaskRunner, jobs: int) -> bool:
+    """
+    Runs every task once all of its dependencies succeeded, at most jobs at a
+    time. A failing task doesn't stop independent ones (like make -k), its
+    dependents are skipped. Returns True if every task succeeded.
+    """
+    from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+    by_name = {t.name: t for t in tasks}
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in by_name:
+                raise ValueError(f"{task.name} depends on unknown task {dep}")
+
+    def execute(task: Task) -> None:
+        task.start = time.monotonic()
+        try:
+            task.status = run_task(task)
+        except Exception as e:
+            task.status = FAILED
+            task.error = str(getattr(e, "stderr", None) or e)
+        finally:
+            task.end = time.monotonic()
+
+    running: dict[Future, Task] = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while True:
+            changed = True
+            while changed:
+                changed = False
+                for task in tasks:
+                    if task.status != PENDING:
+                        continue
+                    dep_states = [by_name[d].status for d in task.deps]
+                    if any(s in (FAILED, SKIPPED) for s in dep_states):
+                        task.status = SKIPPED
+                        changed = True
+                    elif all(s in succeeded for s in dep_states):
+                        task.status = RUNNING
+                        running[pool.submit(execute, task)] = task
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+    stuck = [t for t in tasks if t.status == PENDING]
+    if stuck:
+        raise ValueError(f"dependency cycle between {', '.join(t.name for t in stuck)}")
+    return all(t.status in succeeded for t in tasks)
+
+
+def format_summary(tasks: list[Task]) -> str:
+    lines = []
+    for task in tasks:
+        label = f"[{task.label}] " if task.label else ""
+        timing = (
+            f"{task.duration:7.2f}s"
+            if task.status not in (PENDING, SKIPPED)
+            else " " * 8
+        )
+        lines.append(f"{task.status:>10} {timing} {label}{task.name}")
+        if task.error:
+            lines.extend(f"{'':>19} {line}" for line in task.error.splitlines()[-10:])
+    return "\n".join(lines)
@@ -0,0 +1,163 @@
+"""
+Phase tracing exported as Chrome trace-event JSON, loadable in Perfetto or
+chrome://tracing. Tracing is off unless start() was called, spans are no-ops then.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import threading
+import time
+from typing import Iterator
+
+_events: list[dict] | None = None
+_lock = threading.Lock()
+
+# recipe lines run by make go through this shell, logging
+# "<start ns> <end ns> <exit code> <target>" for every line
+_make_shell = """\
+#!/bin/sh
+start=$(date +%s%N)
+/bin/sh "$@"
+rc=$?
+end=$(date +%s%N)
+printf '%s %s %s %s\\n' "$start" "$end" "$rc" "$XDRVMAKE_TRACE_TARGET" >> '{log}'
+exit $rc
+"""
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def start() -> None:
+    global _events
+    _events = []
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def _add(event: dict) -> None:
+    if _events is None:
+        return
+    event["pid"] = os.getpid()
+    with _lock:
+        _events.append(event)
+
+
+def add_span(
+    name: str,
+    start_us: int,
+    end_us: int,
+    cat: str,
+    tid: int,
+    args: dict | None = None,
+) -> None:
+    event = {
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": start_us,
+        "dur": max(end_us - start_us, 0),
+        "tid": tid,
+    }
+    if args:
+        event["args"] = args
+    _add(event)
+
+
+def name_track(tid: int, name: str) -> None:
+    _add({"name": "thread_name", "ph": "M", "tid": tid, "args": {"name": name}})
+
+
+@contextlib.contextmanager
+def span(name: str, cat: str = "configure", **args: object) -> Iterator[None]:
+    if _events is None:
+        yield
+        return
+    start_us = now_us()
+    try:
+        yield
+    finally:
+        add_span(name, start_us, now_us(), cat, threading.get_native_id(), args)
+
+
+def write(path: str) -> None:
+    import json
+
+    name_track(threading.get_native_id(), "xdrvmake")
+    with open(path, "w") as f:
+        json.dump({"traceEvents": _events or [], "displayTimeUnit": "ms"}, f)
+
+
+def _label(target: str, labels: list[str]) -> str:
+    matches = [label for label in labels if label in target]
+    return max(matches, key=len) if matches else "make"
+
+
+def add_make_spans(log_lines: list[str], labels: list[str]) -> None:
+    """
+    Turns the make shell log into one span per target, on one track per
+    label (kernel version) found in the target name. Targets of the same
+    kernel running in parallel get extra lanes so spans never overlap.
+    """
+    targets: dict[str, list[int]] = {}
+    for line in log_lines:
+        parts = line.split(" ", 3)
+        if len(parts) < 4 or not parts[0].isdigit() or not parts[1].isdigit():
+            continue
+        start_us, end_us = int(parts[0]) // 1000, int(parts[1]) // 1000
+        rc, target = int(parts[2]), parts[3].strip()
+        entry = targets.setdefault(target, [start_us, end_us, 0])
+        entry[0] = min(entry[0], start_us)
+        entry[1] = max(entry[1], end_us)
+        entry[2] = entry[2] or rc
+    lanes: dict[str, list[tuple[int, int]]] = {}
+    next_tid = 1
+    for target, (start_us, end_us, rc) in sorted(
+        targets.items(), key=lambda t: t[1][0]
+    ):
+        label = _label(target, labels)
+        label_lanes = lanes.setdefault(label, [])
+        for i, (tid, lane_end) in enumerate(label_lanes):
+            if lane_end <= start_us:
+                label_lanes[i] = (tid, end_us)
+                break
+        else:
+            tid = next_tid
+            next_tid += 1
+            name_track(
+                tid, label if not label_lanes else f"{label} #{len(label_lanes) + 1}"
+            )
+            label_lanes.append((tid, end_us))
+        add_span(
+            target, start_us, end_us, "make", tid, {"kernel": label, "exit_code": rc}
+        )
+
+
+@contextlib.contextmanager
+def make_tracing(labels: list[str]) -> Iterator[list[str]]:
+    """
+    Yields the extra make arguments that record every recipe line, and adds
+    the resulting per-target spans once the block exits.
+    """
+    if _events is None:
+        yield []
+        return
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix="xdrvmake-trace-") as tmp:
+        log = os.path.join(tmp, "make.log")
+        shell = os.path.join(tmp, "shell")
+        with open(shell, "w") as f:
+            f.write(_make_shell.format(log=log))
+        os.chmod(shell, 0o755)
+        try:
+            yield [f"SHELL={shell}", "XDRVMAKE_TRACE=1"]
+        finally:
+            if os.path.exists(log):
+                with open(log) as f:
+                    add_make_spans(f.readlines(), labels)
@@ -0,0 +1,296 @@
+"""
+Watch mode: rebuilds (and optionally quickdeploys) on every saved edit.
+
+    xdrvmake watch [--build DIR] [--kernel-ver KVER ...] [--target HOST]
+
+The source directory and the device tree of every project in the build
+directory's graph are watched with inotify. Bursts of events (an editor
+saving several files, a git checkout) are debounced into a single rebuild of
+only the targets built from the changed sources, for the selected kernels:
+the given ones, else the running kernel of --target, else all of them.
+
+The process stays up between edits with its state warm: the build graph,
+the inotify watches, one schroot session shared by every rebuild and the
+multiplexed ssh connection of the quickdeploys, so the latency of an edit is
+the compiler's. The project and buildroot locks are only held while a
+rebuild runs, so other builds and configures proceed between edits.
+"""
+
+from __future__ import annotations
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import subprocess
+import sys
+import time
+from typing import Protocol
+
+from xdrvmake import builder, locks
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_event = struct.Struct("iIII")
+
+
+def ignored(name: str) -> bool:
+    # hidden files (kbuild .cmd files, .git) and editor swap/backup files
+    return name.startswith(".") or name.endswith(("~", ".swp", ".swx"))
+
+
+class Watcher(Protocol):
+    def read(self, timeout: float | None = None) -> set[str]: ...
+
+
+class InotifyWatcher:
+    """
+    Watches directory trees (recursively, including directories created
+    later) and single files (through their parent directory), reporting the
+    paths that changed.
+    """
+
+    def __init__(self, paths: list[str]) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.dirs: dict[int, str] = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.add_tree(path)
+            else:
+                self.add_dir(os.path.dirname(path))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def add_dir(self, path: str) -> None:
+        wd = self._add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch: {os.strerror(errno)}", path)
+        self.dirs[wd] = path
+
+    def add_tree(self, path: str) -> None:
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not ignored(d)]
+            self.add_dir(root)
+
+    def watched(self, path: str) -> bool:
+        return any(path == p or path.startswith(p + "/") for p in self.paths)
+
+    def read(self, timeout: float | None = None) -> set[str]:
+        """
+        Waits up to timeout seconds (forever for None) for events, returns
+        the changed paths, empty on a timeout.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 1 << 16)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset : offset + size].rstrip(b"\0").decode(errors="replace")
+            offset += size
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, anything may have changed
+                changed.update(self.paths)
+                continue
+            if wd not in self.dirs or not name or ignored(name):
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if not self.watched(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            changed.add(path)
+        return changed
+
+
+def wait_for_changes(watcher: Watcher, debounce: float) -> set[str]:
+    """
+    Blocks until something changes, then until nothing changed for debounce
+    seconds, and returns every path changed meanwhile.
+    """
+    changed = watcher.read()
+    while True:
+        more = watcher.read(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+
+def affected_targets(graph: dict, changed: set[str], kernels: list[str]) -> list[str]:
+    """
+    The targets of the given kernels built from the changed paths, in graph
+    order.
+    """
+    stale = set()
+    for source, targets in graph["sources"].items():
+        source = os.path.abspath(source)
+        if any(p == source or p.startswith(source + "/") for p in changed):
+            stale.update(targets)
+    return [
+        target
+        for kver in kernels
+        for target in graph["kernels"][kver]
+        if target in stale
+    ]
+
+
+def quickdeploy_targets(graph: dict, targets: list[str]) -> list[str]:
+    """
+    The quickdeploy targets for the rebuilt modules, project prefixed in a
+    workspace like the modules.
+    """
+    deploys = []
+    for kver, kernel_targets in graph["kernels"].items():
+        for target in targets:
+            if target in kernel_targets and target.endswith(".ko"):
+                prefix = target.split("staging/", 1)[0]
+                deploys.append(f"{prefix}quickdeploy-{kver}")
+    return deploys
+
+
+def select_kernels(args: argparse.Namespace, graph: dict) -> list[str]:
+    kernels = list(graph["kernels"])
+    if args.kernel_ver:
+        selected: list[str] = args.kernel_ver
+    elif args.target:
+        from xdrvmake.deploy import SshTransport
+
+        osrelease = "/proc/sys/kernel/osrelease"
+        selected = [SshTransport(10).read(args.target, osrelease).strip()]
+    else:
+        return kernels
+    unknown = [kver for kver in selected if kver not in kernels]
+    if unknown:
+        raise ValueError(
+            f"kernel {', '.join(unknown)} is not configured in {args.build}, "
+            f"configured: {', '.join(kernels)}"
+        )
+    return selected
+
+
+def rebuild(args: argparse.Namespace, graph: dict, targets: list[str]) -> bool:
+    """
+    Makes targets (and quickdeploys the modules to --target) in the open
+    schroot session, returns whether it succeeded.
+    """
+    cmd = ["make", "-C", args.build]
+    if args.jobs > 1:
+        cmd.extend(["-j", str(args.jobs)])
+    cmd.append(f"SCHROOT_SESSION={args.schroot_session}")
+    if args.target:
+        cmd.append(f"TARGET={args.target}")
+        targets = targets + quickdeploy_targets(graph, targets)
+    start = time.monotonic()
+    try:
+        with locks.project_lock(args.build), locks.buildroot_lock(
+            args.chroot_name, shared=True
+        ):
+            builder.exec_command(cmd + targets)
+    except subprocess.CalledProcessError as e:
+        # keep watching, the next save will most likely fix it
+        print(f"rebuild failed ({e.returncode}), waiting for changes", file=sys.stderr)
+        return False
+    print(f"rebuilt in {time.monotonic() - start:.1f}s, waiting for changes")
+    return True
+
+
+def watch(args: argparse.Namespace, watcher: Watcher, graph: dict) -> None:
+    kernels = select_kernels(args, graph)
+    print(f"watching {', '.join(graph['sources'])} for {', '.join(kernels)}")
+    with builder.schroot_session(args):
+        # brings the build up to date before the first edit
+        rebuild(args, graph, [t for kver in kernels for t in graph["kernels"][kver]])
+        while True:
+            changed = wait_for_changes(watcher, args.debounce)
+            targets = affected_targets(graph, changed, kernels)
+            if targets:
+                print(f"changed: {', '.join(sorted(changed))}")
+                rebuild(args, graph, targets)
+
+
+def get_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="xdrvmake watch",
+        description="Rebuild the affected kernels' targets on every source "
+        "change, optionally quickdeploying the modules",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--build", default=os.getcwd(), help="configured build directory"
+    )
+    parser.add_argument(
+        "--kernel-ver",
+        nargs="+",
+        help="kernel versions to rebuild, default: the running kernel of "
+        "--target, else all configured ones",
+    )
+    parser.add_argument(
+        "--target", help="[user@]host to quickdeploy rebuilt modules to"
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.3,
+        help="seconds without changes before a rebuild starts",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of parallel jobs for make (pass to make -j)",
+    )
+    parser.add_argument(
+        "--chroot-root",
+        default="/var/chroot/buildroot/",
+        help="path to the buildroot",
+    )
+    args = parser.parse_args(argv)
+    args.chroot_name = os.path.basename(os.path.normpath(args.chroot_root))
+    args.schroot_session = None
+    return args
+
+
+def main(argv: list[str] | None = None) -> int:
+    import json
+
+    args = get_args(argv)
+    with open(os.path.join(args.build, builder.build_graph_filename)) as f:
+        graph = json.load(f)
+    if "sources" not in graph:
+        print(f"{args.build} was configured by an older xdrvmake, reconfigure it")
+        return 2
+    watcher = InotifyWatcher(list(graph["sources"]))
+    try:
+        watch(args, watcher, graph)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())